@@ -0,0 +1,107 @@
+"""Broadcast latency benchmark for the comm server's fan-out
+
+Registers thousands of simulated websocket connections with comm_server,
+each taking a random 0-2 ms to accept a frame (a few never do), and
+times a presence broadcast through fanout() against sending the same
+frames one connection after another.
+
+Usage: python bench_fanout.py [connections ...]
+"""
+import asyncio
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+# comm_server creates its queue and file directories on import
+_workdir = tempfile.mkdtemp(prefix="bench_fanout_")
+os.environ.setdefault("OFFLINE_QUEUE_DIR", os.path.join(_workdir, "offline_queue"))
+os.environ.setdefault("FILE_STORE_DIR", os.path.join(_workdir, "files"))
+
+import comm_server  # noqa: E402
+import wire  # noqa: E402
+
+HUNG_CLIENTS = 5
+SEND_TIMEOUT = 0.5
+
+
+class SimulatedSocket:
+    """Stands in for a starlette WebSocket; records when each frame arrives"""
+
+    def __init__(self, delay, hung=False):
+        self.delay = delay
+        self.hung = hung
+        self.received_at = None
+
+    async def _receive(self):
+        if self.hung:
+            await asyncio.sleep(3600)
+        await asyncio.sleep(self.delay)
+        self.received_at = time.perf_counter()
+
+    async def send_text(self, data):
+        await self._receive()
+
+    async def send_bytes(self, data):
+        await self._receive()
+
+    async def close(self):
+        pass
+
+
+def connect(count, hung):
+    comm_server.connected_users.clear()
+    comm_server.wire_formats.clear()
+    comm_server.online_users.clear()
+    formats = [(fmt, None) for fmt in wire.available_formats()]
+    sockets = {}
+    for i in range(count):
+        user = f"user{i}"
+        sockets[user] = SimulatedSocket(random.uniform(0, 0.002), hung=i < hung)
+        comm_server.connected_users[user] = sockets[user]
+        comm_server.wire_formats[user] = formats[i % len(formats)]
+        comm_server.online_users.add(user)
+    return sockets
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run(count):
+    # Fan-out: one join delta to everyone, hung clients included
+    sockets = connect(count, HUNG_CLIENTS)
+    start = time.perf_counter()
+    await comm_server.broadcast_presence("newcomer", "join", comm_server.next_presence_version())
+    total = time.perf_counter() - start
+    latencies = [s.received_at - start for s in sockets.values() if s.received_at]
+    # Let the evictions' own leave broadcasts finish before the next run
+    await asyncio.sleep(SEND_TIMEOUT)
+
+    # Baseline: the same frame sent one connection at a time, without hung clients
+    sockets = connect(count, 0)
+    start = time.perf_counter()
+    for user, ws in sockets.items():
+        await ws.send_text(wire.encode({"type": "status", "event": "join", "user": "newcomer", "version": 0}))
+    sequential = time.perf_counter() - start
+
+    print(f"{count} connections ({HUNG_CLIENTS} hung): fan-out done in {total * 1000:.0f} ms, "
+          f"delivery p50 {percentile(latencies, 0.5) * 1000:.1f} ms p99 {percentile(latencies, 0.99) * 1000:.1f} ms; "
+          f"sequential (no hung clients) {sequential * 1000:.0f} ms")
+
+
+async def main(counts):
+    comm_server.SEND_TIMEOUT = SEND_TIMEOUT
+    comm_server.print = lambda *args, **kwargs: None  # Evictions log per connection
+    for count in counts:
+        await run(count)
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main([int(arg) for arg in sys.argv[1:]] or [1000, 2000, 5000]))
+    finally:
+        shutil.rmtree(_workdir, ignore_errors=True)
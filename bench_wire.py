@@ -0,0 +1,179 @@
+"""Wire format benchmark for the comm protocol
+
+Encodes and decodes typical message frames (short chat lines, a large
+paste, a blob reference and legacy inline attachments) with every wire
+format, body codec and permessage-deflate combination, and reports bytes
+on the wire and CPU per frame, per frame kind and for a typical traffic
+mix. Sizes are websocket payload bytes (frame headers excluded). A second
+table sweeps the compression levels.
+
+Usage: python bench_wire.py [scale]
+"""
+import base64
+import json
+import os
+import random
+import sys
+import time
+
+from websockets.extensions.permessage_deflate import PerMessageDeflate
+from websockets.frames import Frame, Opcode
+
+import wire
+
+# Frames generated per kind at scale 1, and how often each kind occurs in the mix
+KINDS = {
+    "chat": (2000, 0.90),
+    "paste": (100, 0.05),
+    "file ref": (500, 0.04),
+    "file inline text": (10, 0.005),
+    "file inline binary": (10, 0.005),
+}
+FILE_SIZE = 256 * 1024
+# The client's permessage-deflate settings (comm_client.py)
+DEFLATE_WINDOW_BITS = 12
+DEFLATE_MEM_LEVEL = 5
+DEFLATE_LEVEL = 6
+
+WORDS = ("the meeting moved to three can you send me the report before lunch thanks "
+         "I will check with finance and get back to you later today ok sounds good "
+         "where is the printer on floor two please call me when you are free").split()
+
+
+def sentence(rng, low, high):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def make_content(kind, rng):
+    if kind == "chat":
+        return sentence(rng, 3, 20)
+    if kind == "paste":
+        # Log-like lines, ~20 KB
+        return "\n".join(f"2024-05-{rng.randint(1, 28):02d} 12:{rng.randint(0, 59):02d} INFO "
+                         f"worker-{rng.randint(1, 8)} {sentence(rng, 4, 12)}" for _ in range(300))
+    if kind == "file ref":
+        return json.dumps({"name": f"report-{rng.randint(1, 999)}.pdf",
+                           "file_id": "%064x" % rng.getrandbits(256), "size": rng.randint(1, 10 ** 8)})
+    if kind == "file inline text":
+        data = "\n".join(sentence(rng, 5, 15) for _ in range(FILE_SIZE // 60)).encode("utf-8")[:FILE_SIZE]
+    else:
+        data = rng.randbytes(FILE_SIZE)
+    return json.dumps({"name": "notes.txt" if kind == "file inline text" else "photo.jpg",
+                       "data": base64.b64encode(data).decode("ascii")})
+
+
+def make_frames(kind, count, rng):
+    return [{"type": "message", "sender": "alice", "content": make_content(kind, rng), "msg_id": f"{kind}-{i}"}
+            for i in range(count)]
+
+
+def deflate_pair(level):
+    """Sender and receiver ends of one permessage-deflate connection (context takeover on)"""
+    settings = {"memLevel": DEFLATE_MEM_LEVEL, "level": level}
+    sender = PerMessageDeflate(False, False, DEFLATE_WINDOW_BITS, DEFLATE_WINDOW_BITS, settings)
+    receiver = PerMessageDeflate(False, False, DEFLATE_WINDOW_BITS, DEFLATE_WINDOW_BITS, settings)
+    return sender, receiver
+
+
+def measure(frames, fmt, codec, deflate_level):
+    """(bytes, encode seconds, decode seconds) for sending frames in order over one connection"""
+    if deflate_level is not None:
+        sender, receiver = deflate_pair(deflate_level)
+    opcode = Opcode.TEXT if fmt == wire.JSON else Opcode.BINARY
+
+    start = time.perf_counter()
+    payloads = []
+    for frame in frames:
+        data = wire.encode(frame, fmt, codec)
+        if isinstance(data, str):
+            data = data.encode("utf-8")  # What the websocket sends for a text frame
+        payload = Frame(opcode, data)
+        if deflate_level is not None:
+            payload = sender.encode(payload)
+        payloads.append(payload)
+    encode_time = time.perf_counter() - start
+    size = sum(len(payload.data) for payload in payloads)
+
+    start = time.perf_counter()
+    for payload, frame in zip(payloads, frames):
+        if deflate_level is not None:
+            payload = receiver.decode(payload, max_size=None)
+        data = payload.data.decode("utf-8") if opcode == Opcode.TEXT else bytes(payload.data)
+        decoded = wire.decode(data)
+    decode_time = time.perf_counter() - start
+    if decoded != frame:
+        raise AssertionError(f"{fmt}/{codec} did not round-trip")
+    return size, encode_time, decode_time
+
+
+def configurations():
+    configs = [("json", wire.JSON, None, None), ("json+deflate", wire.JSON, None, DEFLATE_LEVEL)]
+    if wire.msgpack is not None:
+        configs.append(("msgpack", wire.MSGPACK, None, None))
+        configs.append(("msgpack+deflate", wire.MSGPACK, None, DEFLATE_LEVEL))
+        for codec in wire.available_codecs():
+            configs.append((f"msgpack+{codec}", wire.MSGPACK, codec, None))
+            configs.append((f"msgpack+{codec}+deflate", wire.MSGPACK, codec, DEFLATE_LEVEL))
+    return configs
+
+
+def report(frames_by_kind):
+    mix = {}
+    for kind, frames in frames_by_kind.items():
+        print(f"\n{kind}: {len(frames)} frames")
+        print(f"  {'config':<24}{'bytes/frame':>12}{'vs json':>9}{'encode us':>11}{'decode us':>11}")
+        baseline = None
+        for name, fmt, codec, deflate_level in configurations():
+            size, encode_time, decode_time = measure(frames, fmt, codec, deflate_level)
+            baseline = baseline or size
+            count = len(frames)
+            print(f"  {name:<24}{size / count:>12.0f}{size / baseline:>9.2f}"
+                  f"{encode_time / count * 1e6:>11.1f}{decode_time / count * 1e6:>11.1f}")
+            # Per-frame averages, weighted by how often the kind occurs
+            weight = KINDS[kind][1]
+            total = mix.setdefault(name, [0.0, 0.0, 0.0])
+            total[0] += weight * size / count
+            total[1] += weight * encode_time / count
+            total[2] += weight * decode_time / count
+
+    print("\ntypical mix (" + ", ".join(f"{weight:.1%} {kind}" for kind, (_, weight) in KINDS.items()) + ")")
+    print(f"  {'config':<24}{'KB/1000 msgs':>13}{'vs json':>9}{'CPU ms/1000':>13}")
+    baseline = mix["json"][0]
+    for name, (size, encode_time, decode_time) in mix.items():
+        print(f"  {name:<24}{size * 1000 / 1024:>13.0f}{size / baseline:>9.2f}"
+              f"{(encode_time + decode_time) * 1e6:>13.1f}")
+
+
+def report_levels(frames_by_kind):
+    print("\ncompression levels (bytes/frame, encode+decode us/frame)")
+    sweeps = [("deflate", wire.JSON, None, level) for level in (1, 6, 9)]
+    if wire.msgpack is not None:
+        sweeps += [(wire.ZLIB, wire.MSGPACK, wire.ZLIB, level) for level in (1, 6, 9)]
+        if wire.zstandard is not None:
+            sweeps += [(wire.ZSTD, wire.MSGPACK, wire.ZSTD, level) for level in (1, 3, 9, 19)]
+    default_level = wire.COMPRESS_LEVEL
+    for kind in ("paste", "file inline text"):
+        frames = frames_by_kind[kind]
+        print(f"  {kind}:")
+        for name, fmt, codec, level in sweeps:
+            if codec is None:
+                size, encode_time, decode_time = measure(frames, fmt, None, level)
+            else:
+                wire.COMPRESS_LEVEL = level
+                try:
+                    size, encode_time, decode_time = measure(frames, fmt, codec, None)
+                finally:
+                    wire.COMPRESS_LEVEL = default_level
+            print(f"    {name + ' level ' + str(level):<20}{size / len(frames):>10.0f}"
+                  f"{(encode_time + decode_time) / len(frames) * 1e6:>11.1f}")
+
+
+if __name__ == "__main__":
+    scale = float(sys.argv[1]) if len(sys.argv) > 1 else 1
+    rng = random.Random(int(os.getenv("BENCH_SEED", "1")))
+    frames_by_kind = {kind: make_frames(kind, max(1, int(count * scale)), rng) for kind, (count, _) in KINDS.items()}
+    print(f"formats {wire.available_formats()}, codecs {wire.available_codecs()}, "
+          f"body compression threshold {wire.COMPRESS_THRESHOLD} B level {wire.COMPRESS_LEVEL}, "
+          f"permessage-deflate level {DEFLATE_LEVEL}")
+    report(frames_by_kind)
+    report_levels(frames_by_kind)
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import re
+import time
+
+from storage import write_json_atomic
+
+DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+def file_digest(path, chunk_size=1024 * 1024, on_progress=None):
+    """SHA-256 of a file, read in chunks
+
+    `on_progress(done, total)` is called after every chunk; an exception
+    it raises stops the hashing (that is how callers cancel).
+    """
+    digest = hashlib.sha256()
+    total = os.path.getsize(path) if on_progress else 0
+    done = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+            if on_progress:
+                done += len(chunk)
+                on_progress(done, total)
+    return digest.hexdigest()
+
+
+class BlobStore:
+    """Content-addressed attachment store keyed by SHA-256
+
+    Each distinct file is stored once under `<root>/<aa>/<digest>`.
+    `refs.json` counts the messages that reference each blob; blobs
+    nobody references are removed by gc() once they are older than the
+    grace period (so a fresh upload survives until its message is sent).
+    """
+
+    def __init__(self, root="blobs", grace_period=3600):
+        self.root = root
+        self.grace_period = grace_period
+        self.refs_file = os.path.join(root, "refs.json")
+        os.makedirs(root, exist_ok=True)
+        self.refs = self._load_refs()
+
+    def _load_refs(self):
+        try:
+            with open(self.refs_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save_refs(self):
+        write_json_atomic(self.refs_file, self.refs)
+
+    def path(self, digest):
+        if not DIGEST_PATTERN.match(digest or ""):
+            raise KeyError(digest)
+        return os.path.join(self.root, digest[:2], digest)
+
+    def has(self, digest):
+        try:
+            return os.path.exists(self.path(digest))
+        except KeyError:
+            return False
+
+    def adopt(self, src_path, digest):
+        """Move a fully written file whose hash the caller has checked into the store"""
+        target = self.path(digest)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.exists(target):
+            os.remove(src_path)  # Someone else stored the same content first
+        else:
+            os.replace(src_path, target)
+        self.refs.setdefault(digest, {"refs": 0, "created": time.time()})
+        self._save_refs()
+
+    def incref(self, digest):
+        if not self.has(digest):
+            return False
+        entry = self.refs.setdefault(digest, {"refs": 0, "created": time.time()})
+        entry["refs"] += 1
+        self._save_refs()
+        return True
+
+    def decref(self, digest):
+        entry = self.refs.get(digest)
+        if entry and entry["refs"] > 0:
+            entry["refs"] -= 1
+            self._save_refs()
+
+    def gc(self):
+        """Delete unreferenced blobs past the grace period; returns how many were removed"""
+        cutoff = time.time() - self.grace_period
+        removed = 0
+        for prefix in os.listdir(self.root):
+            prefix_dir = os.path.join(self.root, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for digest in os.listdir(prefix_dir):
+                # Blobs missing from refs.json (e.g. a crash after adopt) count as unreferenced
+                entry = self.refs.get(digest) or {"refs": 0, "created": os.path.getmtime(os.path.join(prefix_dir, digest))}
+                if entry["refs"] == 0 and entry["created"] < cutoff:
+                    os.remove(os.path.join(prefix_dir, digest))
+                    self.refs.pop(digest, None)
+                    removed += 1
+        if removed:
+            self._save_refs()
+        return removed
+
+    def stats(self):
+        return {
+            "blobs": len(self.refs),
+            "referenced": sum(1 for entry in self.refs.values() if entry["refs"] > 0),
+            "references": sum(entry["refs"] for entry in self.refs.values())
+        }
@@ -1,79 +1,348 @@
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import httpx
 import websockets
-import json
+from websockets.extensions.permessage_deflate import ClientPerMessageDeflateFactory
+import os
 import time
 
+import wire
+from blobstore import file_digest
+
+try:
+    import h2  # noqa: F401  (optional; enables HTTP/2 in httpx)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+class TransferCancelled(Exception):
+    pass
+
 class CommClient:
-    def __init__(self, username, server_url="http://localhost:8001", ws_url="ws://localhost:8001/ws"):
+    FILE_WORKERS = 2  # Threads that hash and read attachments, off both the UI and the event loop
+    SEND_ACK_TIMEOUT = 5.0  # Seconds to wait for the server's "sent" ack before using HTTP
+    HTTP_LIMITS = httpx.Limits(max_connections=10, max_keepalive_connections=5, keepalive_expiry=30)
+
+    def __init__(self, username, server_url="http://localhost:8001", ws_url="ws://localhost:8001/ws", wire_format=None,
+                 body_codec=None, ws_compression=None, deflate_level=None):
         self.username = username
         self.server_url = server_url
         self.ws_url = f"{ws_url}/{username}"
+        # JSON unless MessagePack is asked for (and installed); the server confirms in its hello
+        self.requested_format = wire.choose_format(wire_format or os.getenv("COMM_WIRE_FORMAT", wire.JSON))
+        if self.requested_format != wire.JSON:
+            # "auto" offers every codec we have, best first; "none" turns body compression off
+            body_codec = body_codec or os.getenv("COMM_COMPRESS_CODEC", "auto")
+            offered = wire.available_codecs() if body_codec == "auto" else [c for c in [body_codec] if c != "none"]
+            self.ws_url += f"?format={self.requested_format}&codecs={','.join(offered)}"
+        self.wire_format = wire.JSON
+        self.codec = None
+        # permessage-deflate is negotiated by default; level 1-9 trades CPU for bandwidth
+        ws_compression = ws_compression or os.getenv("WS_COMPRESSION", "deflate")
+        deflate_level = deflate_level or int(os.getenv("WS_DEFLATE_LEVEL", "6"))
+        if ws_compression == "off":
+            self._connect_options = {"compression": None}
+        else:
+            self._connect_options = {"compression": None, "extensions": [
+                # Same window/memory settings as websockets' default deflate, plus the level
+                ClientPerMessageDeflateFactory(server_max_window_bits=12, client_max_window_bits=12,
+                                               compress_settings={"memLevel": 5, "level": deflate_level})
+            ]}
         self.ws = None
         self.on_message = None
         self.on_status = None
         self.on_typing = None
+        self.online_users = set()
+        self.presence_version = None  # Version of the last presence snapshot/delta applied
+        self._presence_sync_requested = False
+        self._last_typing_sent = 0
+        self._last_typing_to = None
+        self._pending_sends = {}  # msg_id -> future resolved by the server's "sent" ack
+        self._http = None  # Shared keep-alive client for the HTTP fallback
+        self._file_pool = None  # Worker threads for attachment file I/O and hashing
         self._reconnect_delay = 2
         self._stop = False
 
     async def send_message(self, recipient, content, msg_id=None):
-        async with httpx.AsyncClient() as client:
-            await client.post(f"{self.server_url}/send_message", json={
+        """Send over the open websocket, falling back to HTTP if it is down or no ack comes back"""
+        msg_id = msg_id or f"{self.username}_{recipient}_{time.time()}"
+        if self.ws and await self._send_ws(recipient, content, msg_id):
+            return
+        await self._http_client().post("/send_message", json={
+            "sender": self.username,
+            "recipient": recipient,
+            "content": content,
+            "timestamp": time.time(),
+            "msg_id": msg_id
+        })
+
+    async def send_many(self, messages):
+        """Send a batch of (recipient, content[, msg_id]) tuples
+
+        Over the websocket the frames are pipelined and their acks awaited
+        together; whatever is left goes out in one bulk HTTP request.
+        """
+        batch = []
+        for message in messages:
+            recipient, content = message[0], message[1]
+            msg_id = message[2] if len(message) > 2 and message[2] else f"{self.username}_{recipient}_{time.time()}"
+            batch.append((recipient, content, msg_id))
+        if self.ws:
+            sent = await asyncio.gather(*(self._send_ws(*message) for message in batch))
+            batch = [message for message, ok in zip(batch, sent) if not ok]
+        if batch:
+            await self._http_client().post("/send_messages", json={
                 "sender": self.username,
+                "messages": [
+                    {"recipient": recipient, "content": content, "msg_id": msg_id}
+                    for recipient, content, msg_id in batch
+                ]
+            })
+
+    async def create_upload(self, path, on_progress=None, cancel=None):
+        """Register an upload with the server; returns the file id (its SHA-256)
+
+        If the server already has this content the upload is complete at
+        once, and upload_file() sends nothing. The file is hashed on a
+        worker thread; `on_progress(hashed, total)` reports from that
+        thread, and setting the `cancel` event raises TransferCancelled.
+        """
+        def hash_progress(done, total):
+            if cancel is not None and cancel.is_set():
+                raise TransferCancelled(path)
+            if on_progress:
+                on_progress(done, total)
+        digest = await asyncio.get_running_loop().run_in_executor(
+            self._file_worker(), file_digest, path, 1024 * 1024, hash_progress
+        )
+        response = await self._http_client().post("/files", json={
+            "size": os.path.getsize(path),
+            "sha256": digest
+        })
+        response.raise_for_status()
+        return response.json()["file_id"]
+
+    async def upload_file(self, path, on_progress=None, file_id=None, cancel=None):
+        """Upload a file in chunks and return its file id
+
+        Only one chunk is in flight at a time, so memory stays at one chunk
+        and a slow server slows the sender down. Pass the `file_id` from
+        create_upload (or an interrupted upload) to resume it.
+        `on_progress(sent, total)` is called after every chunk. Setting the
+        `cancel` event stops before the next chunk with TransferCancelled;
+        the server keeps what it has, so the upload can be resumed later.
+        """
+        http = self._http_client()
+        loop = asyncio.get_running_loop()
+        size = os.path.getsize(path)
+        if file_id is None:
+            file_id = await self.create_upload(path, cancel=cancel)
+        response = await http.get(f"/files/{file_id}")
+        response.raise_for_status()
+        status = response.json()
+        file_id, offset, chunk_size = status["file_id"], status["received"], status["chunk_size"]
+        with open(path, "rb") as f:
+            def read_chunk(offset):
+                f.seek(offset)
+                return f.read(chunk_size)
+            while offset < size:
+                if cancel is not None and cancel.is_set():
+                    raise TransferCancelled(path)
+                chunk = await loop.run_in_executor(self._file_worker(), read_chunk, offset)
+                response = await http.put(f"/files/{file_id}/chunks", params={"offset": offset},
+                                          content=chunk, timeout=60.0)
+                if response.status_code == 409:
+                    # Server has a different amount than we thought; continue from there
+                    offset = response.json()["received"]
+                    continue
+                response.raise_for_status()
+                offset = response.json()["received"]
+                if on_progress:
+                    on_progress(offset, size)
+        if not status["complete"]:
+            # Only hand out the id once the server has assembled and verified the file
+            response = await http.get(f"/files/{file_id}")
+            response.raise_for_status()
+            if not response.json()["complete"]:
+                raise ValueError(f"server did not complete the upload of {path}")
+        return file_id
+
+    async def download_file(self, file_id, target_path, on_progress=None):
+        """Stream a file to `target_path`, resuming from a leftover `.part` file"""
+        part_path = target_path + ".part"
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        async with self._http_client().stream("GET", f"/files/{file_id}/content",
+                                              headers=headers, timeout=60.0) as response:
+            if response.status_code == 416:
+                # The .part already holds the whole file
+                os.replace(part_path, target_path)
+                return target_path
+            response.raise_for_status()
+            if response.status_code != 206:
+                offset = 0  # Server ignored the range; start over
+            total = offset + int(response.headers.get("content-length", 0))
+            with open(part_path, "ab" if offset else "wb") as f:
+                async for data in response.aiter_bytes():
+                    f.write(data)
+                    offset += len(data)
+                    if on_progress:
+                        on_progress(offset, total)
+        os.replace(part_path, target_path)
+        return target_path
+
+    def _http_client(self):
+        if self._http is None or self._http.is_closed:
+            self._http = httpx.AsyncClient(
+                base_url=self.server_url,
+                limits=self.HTTP_LIMITS,
+                http2=HTTP2_AVAILABLE,
+                timeout=10.0
+            )
+        return self._http
+
+    def _file_worker(self):
+        if self._file_pool is None:
+            self._file_pool = ThreadPoolExecutor(max_workers=self.FILE_WORKERS, thread_name_prefix="attachments")
+        return self._file_pool
+
+    async def _send_ws(self, recipient, content, msg_id):
+        ack = asyncio.get_running_loop().create_future()
+        self._pending_sends[msg_id] = ack
+        try:
+            await self.ws.send(wire.encode({
+                "type": "send",
                 "recipient": recipient,
                 "content": content,
-                "timestamp": time.time(),
-                "msg_id": msg_id or f"{self.username}_{recipient}_{time.time()}"
-            })
+                "msg_id": msg_id
+            }, self.wire_format, self.codec))
+            await asyncio.wait_for(ack, self.SEND_ACK_TIMEOUT)
+            return True
+        except Exception as e:
+            # Recipients dedup on msg_id, so a late ack plus the HTTP retry is harmless
+            print(f"Websocket send failed, retrying over HTTP: {e!r}")
+            return False
+        finally:
+            self._pending_sends.pop(msg_id, None)
 
     async def connect_ws(self):
         while not self._stop:
             try:
-                async with websockets.connect(self.ws_url) as ws:
+                async with websockets.connect(self.ws_url, **self._connect_options) as ws:
                     self.ws = ws
+                    self.wire_format = wire.JSON
+                    self.codec = None
+                    # The server sends a fresh presence snapshot on every connect
+                    self.presence_version = None
+                    self._presence_sync_requested = True
                     print(f"Connected to websocket as {self.username}")
                     async for msg in ws:
                         try:
-                            print("Raw websocket message:", msg[:100] + "..." if len(msg) > 100 else msg)  # Log first 100 chars
-                            data = json.loads(msg)
-                            if data.get("type") == "message" and self.on_message:
+                            print("Raw websocket message:", msg[:100], "..." if len(msg) > 100 else "")  # Log first 100 chars
+                            data = wire.decode(msg)
+                            if data.get("type") == "hello":
+                                self.wire_format = data.get("format", wire.JSON)
+                                self.codec = data.get("codec")
+                            elif data.get("type") == "message" and self.on_message:
                                 print("Calling on_message handler")
-                                await self.on_message(data)
-                            elif data.get("type") == "status" and self.on_status:
-                                print("Calling on_status handler")
-                                await self.on_status(data)
+                                durable = await self.on_message(data)
+                                # Handled; the server can drop it from our queue once we have it on disk
+                                if data.get("msg_id"):
+                                    if durable is None:
+                                        await self._ack(ws, data["msg_id"])
+                                    else:
+                                        asyncio.create_task(self._ack_when_durable(ws, data["msg_id"], durable))
+                            elif data.get("type") == "sent":
+                                ack = self._pending_sends.get(data.get("msg_id"))
+                                if ack and not ack.done():
+                                    ack.set_result(True)
+                            elif data.get("type") == "status":
+                                if self._apply_presence(data) and self.on_status:
+                                    print("Calling on_status handler")
+                                    await self.on_status(data)
+                                elif self.presence_version is None and not self._presence_sync_requested:
+                                    # Missed a delta; ask for a new snapshot
+                                    self._presence_sync_requested = True
+                                    await ws.send(wire.encode({"type": "presence_sync"}, self.wire_format, self.codec))
                             elif data.get("type") == "typing" and self.on_typing:
                                 print("Calling on_typing handler")
                                 await self.on_typing(data)
-                        except json.JSONDecodeError as e:
-                            print(f"JSON parsing error: {e}")
+                        except ValueError as e:
+                            print(f"Frame parsing error: {e}")
                             print(f"Message content: {msg[:100]}...")  # Log first 100 chars
                         except Exception as e:
                             print(f"Error processing message: {e}")
                             print(f"Message content: {msg[:100]}...")  # Log first 100 chars
             except Exception as e:
                 print(f"Websocket error: {e}. Reconnecting in {self._reconnect_delay}s...")
+                self.ws = None
                 await asyncio.sleep(self._reconnect_delay)
 
-    async def send_typing(self, is_typing=True):
-        """Send typing status with rate limiting"""
+    async def _ack(self, ws, msg_id):
+        await ws.send(wire.encode({"type": "ack", "msg_id": msg_id}, self.wire_format, self.codec))
+
+    async def _ack_when_durable(self, ws, msg_id, durable):
+        """Ack once on_message's awaitable reports the message stored
+
+        Without an ack the server keeps the message and redelivers it on the
+        next connect, where the msg_id dedup drops the copy.
+        """
+        try:
+            if await durable:
+                await self._ack(ws, msg_id)
+        except Exception as e:
+            print(f"Could not ack {msg_id}: {e}")
+
+    def _apply_presence(self, data):
+        """Apply a presence snapshot or join/leave delta; False if a delta is out of sequence"""
+        if "online" in data:
+            self.online_users = set(data["online"])
+            self.presence_version = data.get("version")
+            self._presence_sync_requested = False
+            return True
+        version = data.get("version")
+        if self.presence_version is None:
+            return False  # Waiting for a snapshot
+        if version <= self.presence_version:
+            return False  # Already covered by the snapshot
+        if version != self.presence_version + 1:
+            self.presence_version = None
+            return False
+        if data.get("event") == "join":
+            self.online_users.add(data.get("user"))
+        elif data.get("event") == "leave":
+            self.online_users.discard(data.get("user"))
+        self.presence_version = version
+        return True
+
+    async def send_typing(self, is_typing=True, to=None):
+        """Send typing status for the conversation with `to`, with rate limiting"""
         if self.ws:
             # Rate limit typing events 
             current_time = time.time()
-            if not hasattr(self, '_last_typing_sent'):
-                self._last_typing_sent = 0
-                
             # Only send at most once per second, but always send when typing stops
-            if not is_typing or (current_time - self._last_typing_sent > 1.0):
+            # or moves to another conversation
+            if not is_typing or to != self._last_typing_to or (current_time - self._last_typing_sent > 1.0):
                 try:
-                    await self.ws.send(json.dumps({"type": "typing", "is_typing": is_typing}))
+                    await self.ws.send(wire.encode({"type": "typing", "is_typing": is_typing, "to": to}, self.wire_format, self.codec))
                     self._last_typing_sent = current_time
+                    self._last_typing_to = to
                 except Exception as e:
                     print(f"Error sending typing status: {e}")
 
     def stop(self):
         self._stop = True
 
+    async def close(self):
+        """Stop reconnecting and release the pooled HTTP connections"""
+        self.stop()
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+        if self._file_pool is not None:
+            self._file_pool.shutdown(wait=False, cancel_futures=True)
+            self._file_pool = None
+
 # Example usage:
 # client = CommClient("alice")
 # asyncio.run(client.connect_ws()) 
\ No newline at end of file
@@ -1,11 +1,16 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 import asyncio
 from typing import Dict, List, Set
 import time
 import json
+import os
+
+import wire
+from offline_queue import OfflineQueue
+from transfers import FileStore, ChecksumMismatch
 
 app = FastAPI()
 
@@ -20,9 +25,30 @@ app.add_middleware(
 
 # In-memory structures
 connected_users: Dict[str, WebSocket] = {}
+wire_formats: Dict[str, tuple] = {}  # user -> negotiated (frame format, body codec) for their connection
 online_users: Set[str] = set()
-typing_users: Set[str] = set()
-message_queues: Dict[str, asyncio.Queue] = {}
+typing_to: Dict[str, str] = {}  # user -> peer they are typing to
+typing_for: Dict[str, Set[str]] = {}  # peer -> users typing to them
+typing_dirty: Set[str] = set()  # Peers whose typing list changed since the last tick
+typing_sent: Dict[str, List[str]] = {}  # Last typing list sent to each peer
+typing_flusher = None
+file_store = FileStore(os.getenv("FILE_STORE_DIR", "files"))
+offline_queue = OfflineQueue(
+    spool_dir=os.getenv("OFFLINE_QUEUE_DIR", "offline_queue"),
+    max_in_memory=int(os.getenv("OFFLINE_QUEUE_MEMORY", "200")),
+    max_per_recipient=int(os.getenv("OFFLINE_QUEUE_MAX", "5000")),
+    ttl=float(os.getenv("OFFLINE_QUEUE_TTL", str(7 * 24 * 3600))),
+    # An undelivered message no longer holds on to its attachment
+    on_discard=lambda recipient, msg: release_attachment(msg["content"])
+)
+janitor = None
+presence_version = 0  # Bumped on every join/leave so clients can detect missed deltas
+
+SEND_TIMEOUT = 2.0  # Seconds one client may take to accept a frame before it is dropped
+TYPING_TICK = 0.15  # Seconds between coalesced typing notifications
+HOUSEKEEPING_INTERVAL = 60  # Seconds between sweeps for expired messages and unused files
+# Negotiate permessage-deflate with clients that offer it ("off" to save CPU)
+WS_PER_MESSAGE_DEFLATE = os.getenv("WS_COMPRESSION", "deflate").lower() != "off"
 
 @app.post("/send_message")
 async def send_message(request: Request):
@@ -31,73 +57,316 @@ async def send_message(request: Request):
     recipient = data["recipient"]
     content = data["content"]
     msg_id = data.get("msg_id", f"{sender}_{recipient}_{time.time()}")
-    
-    msg = {
-        "sender": sender,
-        "content": content,
-        "msg_id": msg_id
-    }
-    
-    # Queue message for recipient
-    if recipient not in message_queues:
-        message_queues[recipient] = asyncio.Queue()
-    await message_queues[recipient].put(msg)
-    
-    # If recipient is online, push via websocket
-    if recipient in connected_users:
-        await connected_users[recipient].send_json({"type": "message", **msg})
-    
+    await deliver_message(sender, recipient, content, msg_id)
     return JSONResponse({"status": "ok"})
 
+@app.post("/send_messages")
+async def send_messages(request: Request):
+    """Bulk form of /send_message: {"sender", "messages": [{"recipient", "content", "msg_id"}]}"""
+    data = await request.json()
+    sender = data["sender"]
+    for item in data["messages"]:
+        msg_id = item.get("msg_id", f"{sender}_{item['recipient']}_{time.time()}")
+        await deliver_message(sender, item["recipient"], item["content"], msg_id)
+    return JSONResponse({"status": "ok", "count": len(data["messages"])})
+
 @app.get("/online_users")
 async def get_online_users():
     return list(online_users)
 
+@app.get("/queue_metrics")
+async def get_queue_metrics():
+    return offline_queue.metrics()
+
+@app.get("/file_metrics")
+async def get_file_metrics():
+    return file_store.blobs.stats()
+
+@app.post("/files")
+async def create_upload(request: Request):
+    """Start a chunked upload: {"size", "sha256"} -> {"file_id", "received", "complete", ...}
+
+    The file id is the content hash; if the server already has the file the
+    upload comes back complete and nothing needs to be sent.
+    """
+    data = await request.json()
+    size = int(data["size"])
+    if size < 0:
+        return JSONResponse({"error": "invalid size"}, status_code=400)
+    try:
+        return file_store.create(size, data.get("sha256"))
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+@app.get("/files/{file_id}")
+async def get_upload_status(file_id: str):
+    try:
+        return file_store.status(file_id)
+    except KeyError:
+        return JSONResponse({"error": "unknown file"}, status_code=404)
+
+@app.put("/files/{file_id}/chunks")
+async def upload_chunk(file_id: str, offset: int, request: Request):
+    """Append the request body at `offset`; a 409 carries the offset to resume from"""
+    try:
+        received = await file_store.write_chunk(file_id, offset, request.stream())
+    except KeyError:
+        return JSONResponse({"error": "unknown file"}, status_code=404)
+    except ChecksumMismatch as e:
+        # Retrying won't help: the client's file isn't what it announced
+        return JSONResponse({"error": str(e)}, status_code=422)
+    except ValueError as e:
+        return JSONResponse({"error": str(e), **file_store.status(file_id)}, status_code=409)
+    return {"file_id": file_id, "received": received}
+
+@app.get("/files/{file_id}/content")
+async def download_file(file_id: str):
+    """Completed upload; Range requests let interrupted downloads resume"""
+    try:
+        path = file_store.path(file_id)
+    except KeyError:
+        return JSONResponse({"error": "unknown file"}, status_code=404)
+    # Names live in the messages that reference the file, not with the blob
+    return FileResponse(path, media_type="application/octet-stream")
+
 @app.websocket("/ws/{username}")
 async def websocket_endpoint(websocket: WebSocket, username: str):
     await websocket.accept()
+    ensure_background_tasks()
+    # The hello is always JSON; after it, frames to this client use the agreed format
+    wire_format = wire.choose_format(websocket.query_params.get("format", wire.JSON))
+    codec = None
+    if wire_format == wire.MSGPACK:
+        # Body compression only applies to binary frames
+        codec = wire.choose_codec(websocket.query_params.get("codecs", "").split(","))
+    await websocket.send_text(json.dumps({"type": "hello", "format": wire_format, "codec": codec}))
+    was_online = username in online_users
     connected_users[username] = websocket
+    wire_formats[username] = (wire_format, codec)
     online_users.add(username)
+    # Bump the version before the snapshot so it already covers this join
+    version = presence_version if was_online else next_presence_version()
     try:
-        # Notify others user is online
-        await broadcast_status()
-        # Send queued messages
-        if username in message_queues:
-            while not message_queues[username].empty():
-                msg = await message_queues[username].get()
-                try:
-                    await websocket.send_json({"type": "message", **msg})
-                except Exception as e:
-                    print(f"Error sending queued message: {e}")
+        # Full snapshot for the new connection, a join delta for everyone else
+        await send_presence_snapshot(username, websocket)
+        if not was_online:
+            await broadcast_presence(username, "join", version)
+        # Send queued messages; they stay queued until the client acks them
+        await deliver_queued(username, websocket, offline_queue.pending(username))
         while True:
             try:
-                data = await websocket.receive_json()
-                if data.get("type") == "typing":
-                    if data.get("is_typing"):
-                        typing_users.add(username)
-                    else:
-                        typing_users.discard(username)
-                    await broadcast_typing()
-            except json.JSONDecodeError as e:
-                print(f"Invalid JSON received from {username}: {e}")
+                frame = await websocket.receive()
+                if frame["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(frame.get("code", 1000))
+                # Text frames are JSON and binary frames MessagePack, whatever was negotiated
+                data = wire.decode(frame["text"] if frame.get("text") is not None else frame["bytes"])
+                if data.get("type") == "presence_sync":
+                    # Client noticed a gap in presence versions
+                    await send_presence_snapshot(username, websocket)
+                elif data.get("type") == "send":
+                    # Same as POST /send_message, without a new HTTP request per message
+                    msg_id = data.get("msg_id") or f"{username}_{data['recipient']}_{time.time()}"
+                    await deliver_message(username, data["recipient"], data["content"], msg_id)
+                    await send_payload(username, websocket, {"type": "sent", "msg_id": msg_id})
+                elif data.get("type") == "ack":
+                    # Delivered; acking may pull spilled messages back from disk
+                    more = offline_queue.ack(username, data.get("msg_id"))
+                    await deliver_queued(username, websocket, more)
+                elif data.get("type") == "typing":
+                    # Only the peer of the active conversation hears about it
+                    set_typing(username, data.get("to") if data.get("is_typing") else None)
+            except ValueError as e:
+                print(f"Invalid frame received from {username}: {e}")
+            except (WebSocketDisconnect, RuntimeError):
+                # Socket is gone (or was evicted); leave the receive loop
+                raise
             except Exception as e:
                 print(f"Error processing message from {username}: {e}")
-    except WebSocketDisconnect:
+    except (WebSocketDisconnect, RuntimeError):
         pass
     finally:
-        connected_users.pop(username, None)
-        online_users.discard(username)
-        typing_users.discard(username)
-        await broadcast_status()
-        await broadcast_typing()
+        # A reconnect may already have replaced this socket, or fan-out evicted it
+        if connected_users.get(username) is websocket:
+            connected_users.pop(username, None)
+            wire_formats.pop(username, None)
+            online_users.discard(username)
+            set_typing(username, None)
+            typing_sent.pop(username, None)
+            await broadcast_presence(username, "leave", next_presence_version())
+
+async def send_payload(username, ws, payload):
+    return await send_frame(username, ws, wire.encode(payload, *wire_formats.get(username, (wire.JSON, None))))
+
+async def send_frame(username, ws, frame):
+    """Send one pre-serialized frame with a timeout, evicting the connection on failure"""
+    send = ws.send_bytes if isinstance(frame, bytes) else ws.send_text
+    try:
+        await asyncio.wait_for(send(frame), SEND_TIMEOUT)
+        return True
+    except Exception as e:
+        print(f"Dropping connection for {username}: {e!r}")
+        await evict(username, ws)
+        return False
+
+async def evict(username, ws):
+    """Forget a dead or stalled connection and tell everyone else it is gone"""
+    if connected_users.get(username) is not ws:
+        return
+    connected_users.pop(username, None)
+    wire_formats.pop(username, None)
+    online_users.discard(username)
+    set_typing(username, None)
+    typing_sent.pop(username, None)
+    asyncio.create_task(close_quietly(ws))
+    # Runs after the current fan-out instead of recursing into it
+    asyncio.create_task(broadcast_presence(username, "leave", next_presence_version()))
+
+async def close_quietly(ws):
+    try:
+        await asyncio.wait_for(ws.close(), SEND_TIMEOUT)
+    except Exception:
+        pass
+
+async def fanout(payload, recipients=None):
+    """Send a payload to many connections at once
+    
+    The payload is serialized once per wire format/codec and sent to every
+    recipient concurrently, so one slow or dead client can't hold up the
+    others. Returns the number of successful sends.
+    """
+    if recipients is None:
+        targets = list(connected_users.items())
+    else:
+        targets = [(user, connected_users[user]) for user in recipients if user in connected_users]
+    if not targets:
+        return 0
+    frames = {}
+    sends = []
+    for user, ws in targets:
+        settings = wire_formats.get(user, (wire.JSON, None))
+        if settings not in frames:
+            frames[settings] = wire.encode(payload, *settings)
+        sends.append(send_frame(user, ws, frames[settings]))
+    results = await asyncio.gather(*sends)
+    return sum(results)
+
+async def send_presence_snapshot(username, ws):
+    """Send the full online list; clients apply versioned deltas on top of it"""
+    await send_payload(username, ws, {
+        "type": "status",
+        "online": list(online_users),
+        "version": presence_version
+    })
+
+def next_presence_version():
+    global presence_version
+    presence_version += 1
+    return presence_version
+
+async def broadcast_presence(username, event, version):
+    """Tell everyone else that one user joined or left"""
+    others = [user for user in connected_users if user != username]
+    await fanout({
+        "type": "status",
+        "event": event,
+        "user": username,
+        "version": version
+    }, others)
+
+def set_typing(username, peer):
+    """Record who username is typing to (None when they stop); sent on the next tick"""
+    previous = typing_to.pop(username, None)
+    if previous == peer:
+        if peer:
+            typing_to[username] = peer
+        return
+    if previous:
+        typing_for.get(previous, set()).discard(username)
+        typing_dirty.add(previous)
+    if peer:
+        typing_to[username] = peer
+        typing_for.setdefault(peer, set()).add(username)
+        typing_dirty.add(peer)
+
+async def deliver_message(sender, recipient, content, msg_id):
+    """Queue a message until the recipient acks it and push it if they are online"""
+    msg = {
+        "sender": sender,
+        "content": content,
+        "msg_id": msg_id
+    }
+    # A retry of a message still queued already holds its attachment reference
+    if offline_queue.push(recipient, msg):
+        retain_attachment(content)
+    if recipient in connected_users:
+        await send_payload(recipient, connected_users[recipient], {"type": "message", **msg})
+
+def attachment_id(content):
+    """File id referenced by a message's content, if it is an attachment"""
+    if not isinstance(content, str) or not content.startswith(wire.FILE_PREFIX):
+        return None
+    try:
+        return json.loads(content).get("file_id")
+    except (ValueError, AttributeError):
+        return None
+
+def retain_attachment(content):
+    file_id = attachment_id(content)
+    if file_id:
+        file_store.blobs.incref(file_id)
+
+def release_attachment(content):
+    file_id = attachment_id(content)
+    if file_id:
+        file_store.blobs.decref(file_id)
+
+async def deliver_queued(username, ws, messages):
+    for msg in messages:
+        if not await send_payload(username, ws, {"type": "message", **msg}):
+            break
+
+def ensure_background_tasks():
+    global typing_flusher, janitor
+    if typing_flusher is None or typing_flusher.done():
+        typing_flusher = asyncio.create_task(flush_typing_loop())
+    if janitor is None or janitor.done():
+        janitor = asyncio.create_task(housekeeping_loop())
+
+async def housekeeping_loop():
+    while True:
+        await asyncio.sleep(HOUSEKEEPING_INTERVAL)
+        try:
+            offline_queue.expire()
+            removed = file_store.gc()
+            if removed:
+                print(f"Removed {removed} unused file(s)")
+        except Exception as e:
+            print(f"Error in housekeeping: {e}")
 
-async def broadcast_status():
-    for ws in connected_users.values():
-        await ws.send_json({"type": "status", "online": list(online_users)})
+async def flush_typing_loop():
+    """Every tick, send each peer at most one frame with who is typing to them"""
+    while True:
+        await asyncio.sleep(TYPING_TICK)
+        try:
+            await flush_typing()
+        except Exception as e:
+            print(f"Error flushing typing updates: {e}")
 
-async def broadcast_typing():
-    for ws in connected_users.values():
-        await ws.send_json({"type": "typing", "users": list(typing_users)})
+async def flush_typing():
+    sends = []
+    for peer in list(typing_dirty):
+        typing_dirty.discard(peer)
+        users = sorted(typing_for.get(peer, ()))
+        if not users:
+            typing_for.pop(peer, None)
+        # A start/stop burst inside one tick can end where it began
+        if typing_sent.get(peer, []) == users or peer not in connected_users:
+            continue
+        typing_sent[peer] = users
+        sends.append(send_payload(peer, connected_users[peer], {"type": "typing", "users": users}))
+    if sends:
+        await asyncio.gather(*sends)
 
 if __name__ == "__main__":
-    uvicorn.run("comm_server:app", host="0.0.0.0", port=8001, reload=True) 
\ No newline at end of file
+    uvicorn.run("comm_server:app", host="0.0.0.0", port=8001, reload=True,
+                ws_per_message_deflate=WS_PER_MESSAGE_DEFLATE) 
\ No newline at end of file
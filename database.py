@@ -1,23 +1,123 @@
 import json
 import os
 from security import SecurityManager
+from storage import (JsonlMessageStore, ShardedMessageStore, SqliteMessageStore, GroupCommitWriter,
+                     file_lock, migrate_to_sqlite, write_json_atomic)
 import time
+import threading
+from collections import OrderedDict, deque
 import flet as ft
 
+class PlaintextCache:
+    """Bounded LRU cache of decrypted message bodies keyed by message id"""
+
+    def __init__(self, max_entries=2000, max_bytes=8 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value):
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            # Evict least recently used entries until both limits hold
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+class LazyMessage(dict):
+    """Message record that keeps its ciphertext and decrypts "message" on first access"""
+
+    def __init__(self, record, decrypt):
+        super().__init__(record)
+        self["ciphertext"] = self.pop("message")
+        self._decrypt = decrypt
+
+    def __missing__(self, key):
+        if key != "message":
+            raise KeyError(key)
+        plaintext = self._decrypt(self)
+        self["message"] = plaintext
+        return plaintext
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+def message_key(record):
+    """Stable id for a stored message, for records saved before msg_id existed"""
+    return record.get("msg_id") or f"{record['sender']}_{record['receiver']}_{record['timestamp']}"
+
 class Database:
-    def __init__(self):
+    def __init__(self, backend=None):
         self.users_file = "users.json"
-        self.messages_file = "messages.json"
+        self.messages_file = "messages.jsonl"
+        self.legacy_messages_file = "messages.json"
+        self.messages_dir = "messages"
+        self.sqlite_file = "messages.db"
+        self.backend = backend or os.getenv("DB_BACKEND", "sharded")
         self.security = SecurityManager()
+        self.plaintext_cache = PlaintextCache()
+        
+        # Duplicate detection index: recent content hashes and message ids. This is the
+        # in-process fast path; the store itself never writes a msg_id twice.
+        self.dedup_window = 1.0  # Seconds within which identical content is a duplicate
+        self.max_seen_ids = 10000
+        self._recent_digests = {}  # (sender, receiver, digest) -> timestamp
+        self._recent_order = deque()  # (timestamp, key) in insertion order, for expiry
+        self._seen_ids = OrderedDict()
+        self._dedup_lock = threading.Lock()
+        
+        # In-memory copy of users.json, reloaded only when the file changes
+        self._users = None
+        self._users_stamp = None
+        self._users_lock = threading.RLock()
         
         # Initialize files if they don't exist
         if not os.path.exists(self.users_file):
             with open(self.users_file, "w") as f:
                 json.dump({}, f)
         
-        if not os.path.exists(self.messages_file):
-            with open(self.messages_file, "w") as f:
-                json.dump([], f)
+        if self.backend == "sqlite":
+            # Import existing JSON history the first time SQLite is used
+            with file_lock(self.sqlite_file + ".lock"):
+                if not os.path.exists(self.sqlite_file):
+                    migrate_to_sqlite(self.sqlite_file, self.messages_file, self.legacy_messages_file, self.messages_dir)
+            self.store = SqliteMessageStore(self.sqlite_file)
+        elif self.backend == "jsonl":
+            # Messages live in an append-only log so a send never rewrites history
+            self.store = JsonlMessageStore(self.messages_file, legacy_path=self.legacy_messages_file)
+        else:
+            # One append-only log per conversation, so a chat only reads its own history
+            self.store = ShardedMessageStore(
+                self.messages_dir,
+                legacy_log=self.messages_file,
+                legacy_path=self.legacy_messages_file
+            )
+        
+        # Saves from the UI and comm threads are coalesced into group commits
+        self.writer = GroupCommitWriter(self.store)
     
     def register_user(self, username, password):
         # Validate input
@@ -29,23 +129,26 @@ class Database:
         if not valid:
             return False, message
         
-        with open(self.users_file, "r") as f:
-            users = json.load(f)
-        
-        if username in users:
+        if username in self._load_users():
             return False, "Username already exists"
         
-        # Hash password with Argon2
-        users[username] = self.security.hash_password(password)
+        # Hash password with Argon2 outside the lock, it is slow
+        password_hash = self.security.hash_password(password)
         
-        with open(self.users_file, "w") as f:
-            json.dump(users, f)
+        # Hold the cross-process lock so two clients can't overwrite each other's registrations
+        with self._users_lock, file_lock(self.users_file + ".lock"):
+            users = self._load_users()
+            if username in users:
+                return False, "Username already exists"
+            
+            users = dict(users)
+            users[username] = password_hash
+            self._write_users(users)
         
         return True, "User registered successfully"
     
     def authenticate_user(self, username, password):
-        with open(self.users_file, "r") as f:
-            users = json.load(f)
+        users = self._load_users()
         
         if username not in users:
             return False, "User does not exist"
@@ -56,89 +159,145 @@ class Database:
         
         return True, "Authentication successful"
     
-    def save_message(self, sender, receiver, message):
-        print("Saving message:", message, "type:", type(message))
+    def save_message(self, sender, receiver, message, msg_id=None, wait=True):
+        """Save one message; with wait=False it is committed in the background
         
-        # Read existing messages
-        with open(self.messages_file, "r") as f:
-            messages = json.load(f)
+        With wait=False the return value is a ticket whose wait() returns
+        True once the message is on disk.
+        """
+        print("Saving message:", message, "type:", type(message))
         
         if not isinstance(message, str):
             message = str(message)
         
-        # Encrypt message with Fernet
-        encrypted_message = self.security.encrypt_message(message)
+        prepared = self._prepare_record(sender, receiver, message, msg_id)
+        if prepared is None:
+            print("Duplicate message detected, not saving")
+            # The first copy may still be queued; this completes after it
+            return None if wait else self.writer.submit([])
+        record, digest_key = prepared
         
-        # Check for duplicates by comparing content and timestamps within last 1 second
+        ticket = None
+        if wait:
+            self._commit([record], [digest_key])
+        else:
+            ticket = self.writer.submit([record])
+        # The sender is about to render this message, so keep its plaintext
+        self.plaintext_cache.put(record["msg_id"], message)
+        return ticket
+    
+    def save_messages(self, batch):
+        """Save (sender, receiver, message[, msg_id]) tuples in one commit
+        
+        Returns the number of messages written after duplicates are dropped.
+        """
+        records = []
+        digest_keys = []
+        plaintexts = []
+        for item in batch:
+            sender, receiver, message = item[0], item[1], item[2]
+            msg_id = item[3] if len(item) > 3 else None
+            if not isinstance(message, str):
+                message = str(message)
+            prepared = self._prepare_record(sender, receiver, message, msg_id)
+            if prepared is not None:
+                records.append(prepared[0])
+                digest_keys.append(prepared[1])
+                plaintexts.append(message)
+        if records:
+            self._commit(records, digest_keys)
+            for record, message in zip(records, plaintexts):
+                self.plaintext_cache.put(record["msg_id"], message)
+        return len(records)
+    
+    def _prepare_record(self, sender, receiver, message, msg_id):
+        """Encrypt a message into (record, digest_key), or return None if it is a duplicate"""
         current_time = time.time()
-        for existing_msg in reversed(messages):
-            # If same sender and receiver pair
-            if existing_msg["sender"] == sender and existing_msg["receiver"] == receiver:
-                # If message was sent within the last 1 second, check content
-                if current_time - existing_msg["timestamp"] < 1:
-                    # Try decrypting to compare contents
-                    try:
-                        decrypted = self.security.decrypt_message(existing_msg["message"])
-                        if decrypted == message:
-                            print("Duplicate message detected, not saving")
-                            return
-                    except:
-                        # If decryption fails, just continue
-                        pass
-        
-        # Add new message
-        messages.append({
+        digest_key = (sender, receiver, self.security.content_digest(message))
+        
+        with self._dedup_lock:
+            if self._is_duplicate(msg_id, digest_key, current_time):
+                return None
+            msg_id = msg_id or f"{sender}_{receiver}_{current_time}"
+            self._remember(msg_id, digest_key, current_time)
+        
+        # Encrypt message with Fernet
+        record = {
             "sender": sender,
             "receiver": receiver,
-            "message": encrypted_message,
-            "timestamp": current_time
-        })
-        
-        with open(self.messages_file, "w") as f:
-            json.dump(messages, f)
+            "message": self.security.encrypt_message(message),
+            "timestamp": current_time,
+            "msg_id": msg_id
+        }
+        return record, digest_key
+    
+    def _commit(self, records, digest_keys):
+        """Write records through the group-commit writer, blocking until durable"""
+        try:
+            self.writer.write(records)
+        except Exception:
+            # Let a retry of the same messages through the dedup index
+            with self._dedup_lock:
+                for record, digest_key in zip(records, digest_keys):
+                    self._seen_ids.pop(record["msg_id"], None)
+                    self._recent_digests.pop(digest_key, None)
+            raise
+    
+    def _is_duplicate(self, msg_id, digest_key, current_time):
+        """Check the dedup index; caller holds _dedup_lock"""
+        if msg_id and msg_id in self._seen_ids:
+            return True
+        # Slide the time window forward
+        while self._recent_order and current_time - self._recent_order[0][0] >= self.dedup_window:
+            timestamp, key = self._recent_order.popleft()
+            if self._recent_digests.get(key) == timestamp:
+                del self._recent_digests[key]
+        return digest_key in self._recent_digests
     
-    def get_messages(self, user1, user2=None):
-        with open(self.messages_file, "r") as f:
-            messages = json.load(f)
+    def _remember(self, msg_id, digest_key, current_time):
+        """Record a saved message in the dedup index; caller holds _dedup_lock"""
+        self._recent_digests[digest_key] = current_time
+        self._recent_order.append((current_time, digest_key))
+        self._seen_ids[msg_id] = None
+        if len(self._seen_ids) > self.max_seen_ids:
+            self._seen_ids.popitem(last=False)
+    
+    def _decrypt_record(self, msg):
+        """Decrypt a LazyMessage's ciphertext through the plaintext cache"""
+        key = message_key(msg)
+        plaintext = self.plaintext_cache.get(key)
+        if plaintext is not None:
+            return plaintext
+        encrypted_content = msg["ciphertext"]
+        # Try to decrypt message, handle any errors
+        try:
+            # Check if this looks like an encrypted message
+            if encrypted_content.startswith("gAAAAAB"):
+                plaintext = self.security.decrypt_message(encrypted_content)
+            else:
+                # If it doesn't look encrypted, keep it as is (might be already decrypted)
+                plaintext = encrypted_content
+        except Exception as e:
+            print(f"Error decrypting message: {e}")
+            return "[Encrypted message]"
+        self.plaintext_cache.put(key, plaintext)
+        return plaintext
+    
+    def get_messages(self, user1, user2=None, before=None, since=None, limit=None):
+        """Get messages for user1 (with user2 if given), oldest first
+
+        Pass `limit` with `before` (a timestamp cursor) to page backwards
+        through history, e.g. the 50 messages before the oldest one shown.
+        """
+        # Make sure background saves are visible to this read
+        self.writer.flush()
         
         filtered_messages = []
-        for msg in messages:
+        # The store only returns messages exchanged between the requested users.
+        # Bodies stay encrypted until the caller reads msg["message"].
+        for msg in self.store.query(user1, user2, before=before, since=since, limit=limit):
             try:
-                if user2:
-                    # Get messages between two specific users
-                    if (msg["sender"] == user1 and msg["receiver"] == user2) or \
-                       (msg["sender"] == user2 and msg["receiver"] == user1):
-                        # Make a copy of the message to avoid modifying the original
-                        msg_copy = msg.copy()
-                        # Try to decrypt message, handle any errors
-                        try:
-                            encrypted_content = msg["message"]
-                            # Check if this looks like an encrypted message
-                            if encrypted_content.startswith("gAAAAAB"):
-                                msg_copy["message"] = self.security.decrypt_message(encrypted_content)
-                            # If it doesn't look encrypted, keep it as is (might be already decrypted)
-                        except Exception as e:
-                            print(f"Error decrypting message: {e}")
-                            msg_copy["message"] = "[Encrypted message]"
-                        
-                        filtered_messages.append(msg_copy)
-                else:
-                    # Get all messages for a user
-                    if msg["sender"] == user1 or msg["receiver"] == user1:
-                        # Make a copy of the message to avoid modifying the original
-                        msg_copy = msg.copy()
-                        # Try to decrypt message, handle any errors
-                        try:
-                            encrypted_content = msg["message"]
-                            # Check if this looks like an encrypted message
-                            if encrypted_content.startswith("gAAAAAB"):
-                                msg_copy["message"] = self.security.decrypt_message(encrypted_content)
-                            # If it doesn't look encrypted, keep it as is (might be already decrypted)
-                        except Exception as e:
-                            print(f"Error decrypting message: {e}")
-                            msg_copy["message"] = "[Encrypted message]"
-                        
-                        filtered_messages.append(msg_copy)
+                filtered_messages.append(LazyMessage(msg, self._decrypt_record))
             except Exception as e:
                 print(f"Error processing message: {e}")
         
@@ -147,10 +306,43 @@ class Database:
         
         return filtered_messages
     
+    def iter_messages(self, user1, user2=None, before=None, since=None):
+        """Stream messages for user1 (with user2 if given) without loading the whole archive
+        
+        Records are parsed and filtered one at a time, so peak memory depends
+        on what the caller keeps, not on the size of the history.
+        """
+        self.writer.flush()
+        for msg in self.store.iter_query(user1, user2, before=before, since=since):
+            yield LazyMessage(msg, self._decrypt_record)
+    
+    def as_message(self, record):
+        """A record just passed to save_message, shaped like the ones iter_messages yields"""
+        return LazyMessage(record, self._decrypt_record)
+    
     def get_all_users(self):
-        with open(self.users_file, "r") as f:
-            users = json.load(f)
-        return list(users.keys())
+        return list(self._load_users().keys())
+    
+    def _users_file_stamp(self):
+        stat = os.stat(self.users_file)
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    
+    def _load_users(self):
+        """Return the cached user table, re-reading users.json only if it changed on disk"""
+        with self._users_lock:
+            stamp = self._users_file_stamp()
+            if self._users is None or stamp != self._users_stamp:
+                with open(self.users_file, "r") as f:
+                    self._users = json.load(f)
+                self._users_stamp = stamp
+            return self._users
+    
+    def _write_users(self, users):
+        """Write users.json atomically and update the cache"""
+        with self._users_lock:
+            write_json_atomic(self.users_file, users)
+            self._users = users
+            self._users_stamp = self._users_file_stamp()
 
     def get_hint_style(self):
         current_theme = ft.Theme.current().to_dict()
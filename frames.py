@@ -0,0 +1,62 @@
+import threading
+import time
+
+
+class FrameScheduler:
+    """Coalesces UI refresh requests into at most one flush per frame
+
+    Any thread (Flet callbacks, the comm loop, timers) calls request() after
+    changing controls; a single owner thread calls `flush` (page.update)
+    once per frame interval while something is dirty. A burst of incoming
+    messages therefore costs one UI round-trip per frame instead of one or
+    two per message. flush_now() is for the few callers that need the
+    client to have the new controls right away, e.g. before scroll_to().
+    """
+
+    def __init__(self, flush, interval=1 / 30):
+        self.flush = flush
+        self.interval = interval
+        self.requests = 0
+        self.flushes = 0
+        self._dirty = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._last_flush = 0.0
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name="frame-scheduler", daemon=True)
+        self._thread.start()
+
+    def request(self):
+        """Mark the page dirty; it is flushed on the next frame"""
+        self.requests += 1
+        self._dirty.set()
+
+    def flush_now(self):
+        """Flush on the calling thread, absorbing any pending request"""
+        self._dirty.clear()
+        self._flush()
+
+    def _flush(self):
+        with self._flush_lock:
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"UI update failed: {e}")
+            self.flushes += 1
+            self._last_flush = time.monotonic()
+
+    def _run(self):
+        while not self._stop:
+            self._dirty.wait()
+            if self._stop:
+                break
+            # Let the rest of the burst land before flushing
+            delay = self._last_flush + self.interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            # Cleared before flushing so changes made during the flush get the next frame
+            self._dirty.clear()
+            self._flush()
+
+    def stop(self):
+        self._stop = True
+        self._dirty.set()
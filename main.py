@@ -1,17 +1,24 @@
 import flet as ft
-from database import Database
+from database import Database, message_key
+from roster import Roster
+from frames import FrameScheduler
 import time
 import os
 from datetime import datetime
 import threading
 import json
 import emoji
-from comm_client import CommClient
+from comm_client import CommClient, TransferCancelled
 import asyncio
 import base64
+from itertools import islice
 from playsound import playsound
 
 class OfficeMessenger:
+    HISTORY_PAGE_SIZE = 50  # Messages loaded per page of chat history
+    HISTORY_LOAD_THRESHOLD = 100  # Pixels from either end that trigger loading another page
+    CHAT_WINDOW_SIZE = 150  # Most message bubbles kept in the chat view at once
+
     def __init__(self):
         self.db = Database()
         self.current_user = None
@@ -20,18 +27,32 @@ class OfficeMessenger:
         self.network = None
         self.is_dark_theme = False
         self.emoji_data = list(emoji.EMOJI_DATA.keys())
-        self.unseen_messages = {}  # Track unseen messages per user
+        self.roster = Roster()  # Users shown in the user list, with presence and unread counts
+        self.user_rows = {}  # user -> parts of their row in user_list, patched in place
+        self.user_rows_dark = False  # Theme the user rows were last styled for
         self.comm_client = None
         self.comm_loop = None
         self.comm_thread = None
-        self._pending_update = False
+        self.frames = None  # FrameScheduler owning page.update(), created with the page
         self.typing_timeout = None  # For debouncing typing events
         self.typing_users = set()   # Track who is typing
         self.sent_message_ids = set()  # Track message IDs we've already processed
         self.chat_scroll_pos = 0  # Track chat scroll position
+        self.chat_loaded_with = None  # Peer whose history is currently loaded
+        self.chat_oldest_ts = None  # Timestamp cursor of the oldest loaded message
+        self.chat_newest_ts = None  # Timestamp cursor of the newest loaded message
+        self.chat_controls = {}  # message key -> bubble control currently in chat_view
+        self.chat_has_more = False  # Whether older history exists beyond the cursor
+        self.chat_has_newer = False  # Whether the window stops short of the latest message
+        self.chat_recycled = []  # Bubble containers scrolled out of the window, ready for reuse
+        self.loading_older = False
+        self.active_uploads = set()  # Cancel events of the uploads in progress
+        self.uploads_lock = threading.Lock()  # active_uploads changes on the comm thread, is read on the UI thread
         self.notification_sound = "notification.wav"  # Path to notification sound
         
     def main(self, page: ft.Page):
+        # Every refresh goes through one scheduler that flushes at most once per frame
+        self.frames = FrameScheduler(page.update)
         # Configure page
         page.title = "Office IP Messenger"
         page.theme_mode = ft.ThemeMode.LIGHT
@@ -104,11 +125,18 @@ class OfficeMessenger:
                 return
             if not self.chat_with:
                 return
-            # If a file is pending, send it as JSON payload
+            # A pending file is uploaded in the background; the message only references it
             if hasattr(self, 'pending_file') and self.pending_file:
-                message = json.dumps(self.pending_file)
-                # clear pending file
+                pending = self.pending_file
                 del self.pending_file
+                if self.comm_client and self.comm_loop:
+                    asyncio.run_coroutine_threadsafe(
+                        self.send_file(self.chat_with, pending["path"], pending["name"]),
+                        self.comm_loop
+                    )
+                self.message_field.value = ""
+                self.request_update()
+                return
             else:
                 message = self.message_field.value
             
@@ -124,13 +152,13 @@ class OfficeMessenger:
                     self.comm_loop
                 )
                 # Also save message locally to display immediately for sender
-                self.db.save_message(self.current_user, self.chat_with, message)
+                self.db.save_message(self.current_user, self.chat_with, message, msg_id)
                 # Update the chat view to show sent message immediately
-                self.update_chat()
+                self.update_chat(jump_to_latest=True)
             self.message_field.value = ""
             # Turn off typing indicator when sending a message
             self.set_typing(False)
-            page.update()
+            self.request_update()
 
         # Now create message field with the handler
         self.message_field = ft.TextField(
@@ -246,12 +274,8 @@ class OfficeMessenger:
                 file_info = e.files[0]
                 file_name = file_info.name
                 file_path = file_info.path
-                # Read and encode file content
-                with open(file_path, 'rb') as f:
-                    data = f.read()
-                encoded = base64.b64encode(data).decode('utf-8')
-                # Store pending file payload
-                self.pending_file = {"name": file_name, "data": encoded}
+                # Uploaded in chunks on send instead of being read into memory here
+                self.pending_file = {"name": file_name, "path": file_path}
                 # Update field to show attachment
                 self.message_field.value = f"📎 File: {file_name}"
 
@@ -263,7 +287,7 @@ class OfficeMessenger:
             password = self.password_field.value
             if not username or not password:
                 self.login_message.value = "Please enter both username and password"
-                page.update()
+                self.request_update()
                 return
             success, message = self.db.authenticate_user(username, password)
             if success:
@@ -271,7 +295,7 @@ class OfficeMessenger:
                 self.chat_with = None  # Reset chat_with when logging in
                 self.login_message.value = ""
                 # Clear any existing messages in the chat view
-                self.chat_view.controls.clear()
+                self.clear_chat_view()
                 self.chat_header.value = ""
                 # Initialize CommClient
                 self.comm_client = CommClient(username)
@@ -287,10 +311,10 @@ class OfficeMessenger:
                 self.comm_client.on_typing = self.handle_typing_update
                 # Remove legacy NetworkManager initialization
                 self.show_chat_screen()
-                page.update()
+                self.request_update()
             else:
                 self.login_message.value = message
-                page.update()
+                self.request_update()
         
         def register_click(e):
             username = self.username_field.value
@@ -298,17 +322,17 @@ class OfficeMessenger:
             
             if not username or not password:
                 self.login_message.value = "Please enter both username and password"
-                page.update()
+                self.request_update()
                 return
                 
             success, message = self.db.register_user(username, password)
             
             if success:
                 self.login_message.value = "Registration successful! You can now login."
-                page.update()
+                self.request_update()
             else:
                 self.login_message.value = message
-                page.update()
+                self.request_update()
         
         def toggle_emoji_picker(e):
             # Toggle the emoji grid visibility
@@ -322,18 +346,35 @@ class OfficeMessenger:
                     col_control.height = 200 if self.emoji_grid.visible else 0
                     break
             # Refresh UI
-            page.update()
+            self.request_update()
         
         def upload_file(e):
+            # While uploads run, the attach button cancels them
+            with self.uploads_lock:
+                uploads = list(self.active_uploads)
+            if uploads:
+                for cancel in uploads:
+                    cancel.set()
+                self.message_field.hint_text = "Cancelling upload..."
+                self.request_update()
+                return
             self.file_picker.pick_files(allow_multiple=False)
         
+        self.attach_button = ft.IconButton(
+            icon=ft.Icons.ATTACH_FILE,
+            tooltip="Attach file",
+            on_click=upload_file,
+            icon_color=current_theme["icon_color"],
+            icon_size=24
+        )
+        
         def select_user(e):
             self.chat_with = e.control.data
             # Clear unread count for this user
-            if self.chat_with in self.unseen_messages:
-                self.unseen_messages[self.chat_with] = 0
+            self.roster.clear_unread(self.chat_with)
+            self.update_users()
             self.update_chat()
-            page.update()
+            self.request_update()
         
         def logout(e):
             self.current_user = None
@@ -346,7 +387,10 @@ class OfficeMessenger:
             
             # Stop the websocket client
             if self.comm_client:
-                self.comm_client.stop()
+                if self.comm_loop:
+                    asyncio.run_coroutine_threadsafe(self.comm_client.close(), self.comm_loop)
+                else:
+                    self.comm_client.stop()
             
             # Clear any timers
             if self.typing_timeout:
@@ -370,11 +414,11 @@ class OfficeMessenger:
                 pass
             
             # Clear chat view and header
-            self.chat_view.controls.clear()
+            self.clear_chat_view()
             self.chat_header.value = ""
             
             self.show_login_screen()
-            page.update()
+            self.request_update()
         
         def toggle_theme(e):
             self.is_dark_theme = not self.is_dark_theme
@@ -393,6 +437,10 @@ class OfficeMessenger:
             if hasattr(self, 'chat_screen'):
                 self.update_chat_screen_theme(current_theme)
             
+            # Recolor chat bubbles in place
+            if hasattr(self, 'restyle_chat'):
+                self.restyle_chat(current_theme)
+            
             # Update message field
             if hasattr(self, 'message_field'):
                 self.message_field.bgcolor = current_theme["card_color"]
@@ -406,7 +454,7 @@ class OfficeMessenger:
                         current_theme["secondary_color"] if e.data == "true" else current_theme["card_color"])
             
             # Force update all controls
-            page.update()
+            self.request_update()
         
         # Login screen
         self.login_screen = ft.Container(
@@ -729,13 +777,7 @@ class OfficeMessenger:
                                         icon_color=current_theme["icon_color"],
                                         icon_size=24
                                     ),
-                                    ft.IconButton(
-                                        icon=ft.Icons.ATTACH_FILE,
-                                        tooltip="Attach file",
-                                        on_click=upload_file,
-                                        icon_color=current_theme["icon_color"],
-                                        icon_size=24
-                                    ),
+                                    self.attach_button,
                                     ft.Container(
                                         content=self.message_field,
                                         expand=True,
@@ -775,41 +817,18 @@ class OfficeMessenger:
         page.add(self.login_screen)
         
         # Helper methods for UI management
-        def update_user_list():
-            self.user_list.controls.clear()
-            users = self.db.get_all_users()
-            theme_mode = "dark" if self.is_dark_theme else "light"
-            current_theme = self.theme[theme_mode]
-            for user in users:
-                if user == self.current_user:
-                    continue
-                # Count unread messages
-                unread_count = self.unseen_messages.get(user, 0)
-                
-                # Extract first letter of username for avatar
-                first_letter = user[0].upper()
-                
-                badge = None
-                if unread_count > 0:
-                    badge = ft.Container(
-                        content=ft.Text(
-                            str(unread_count if unread_count < 100 else "99+"),
-                            color=current_theme["button_text_color"],
-                            size=11,
-                            weight=ft.FontWeight.BOLD,
-                            text_align=ft.TextAlign.CENTER
-                        ),
-                        bgcolor=current_theme["primary_color"],
-                        height=22,
-                        width=22,
-                        border_radius=11,
-                        alignment=ft.alignment.center,
-                        padding=ft.padding.symmetric(horizontal=4)
-                    )
-                
-                avatar = ft.Container(
+        def hover_user_row(e):
+            if e.control.data == self.chat_with:
+                return
+            current_theme = self.theme["dark" if self.is_dark_theme else "light"]
+            e.control.bgcolor = current_theme["secondary_color"] if e.data == "true" else current_theme["card_color"]
+        
+        def build_user_row(user):
+            """Build a user's row once; style_user_row() fills in everything that changes"""
+            row = {
+                "avatar": ft.Container(
                     content=ft.Text(
-                        first_letter,
+                        user[0].upper(),  # First letter of username for avatar
                         color="#FFFFFF",
                         size=16,
                         weight=ft.FontWeight.BOLD,
@@ -817,70 +836,201 @@ class OfficeMessenger:
                     ),
                     width=38,
                     height=38,
-                    bgcolor=current_theme["primary_color"],
                     border_radius=19,
                     alignment=ft.alignment.center,
                     margin=ft.margin.only(right=10)
-                )
-                
-                # Show online indicator
-                is_online = hasattr(self, 'online_users') and user in getattr(self, 'online_users', set())
-                
-                user_row = ft.Row([
-                    ft.Stack([
-                        avatar,
-                        ft.Container(
-                            width=12,
-                            height=12,
-                            border_radius=6,
-                            bgcolor="#4CAF50" if is_online else "#9E9E9E",
-                            border=ft.border.all(1, "#FFFFFF"),
-                            right=0,
-                            bottom=0,
-                            visible=True
-                        )
-                    ], width=38),
-                    ft.Column([
-                        ft.Text(
-                            user,
-                            size=15,
-                            weight=ft.FontWeight.BOLD,
-                            color="#FFFFFF" if self.is_dark_theme else current_theme["text_color"]
-                        ),
-                        ft.Text(
-                            "Online" if is_online else "Offline",
-                            size=12,
-                            color="#FFFFFF" if self.is_dark_theme else current_theme["text_color"],
-                            opacity=0.6
+                ),
+                # Online indicator
+                "dot": ft.Container(
+                    width=12,
+                    height=12,
+                    border_radius=6,
+                    border=ft.border.all(1, "#FFFFFF"),
+                    right=0,
+                    bottom=0,
+                    visible=True
+                ),
+                "name": ft.Text(user, size=15, weight=ft.FontWeight.BOLD),
+                "status": ft.Text("", size=12, opacity=0.6),
+                "badge_text": ft.Text(
+                    "",
+                    size=11,
+                    weight=ft.FontWeight.BOLD,
+                    text_align=ft.TextAlign.CENTER
+                ),
+                "state": None
+            }
+            row["badge"] = ft.Container(
+                content=row["badge_text"],
+                height=22,
+                width=22,
+                border_radius=11,
+                alignment=ft.alignment.center,
+                padding=ft.padding.symmetric(horizontal=4)
+            )
+            row["item"] = ft.Container(
+                content=ft.Row([
+                    ft.Stack([row["avatar"], row["dot"]], width=38),
+                    ft.Column([row["name"], row["status"]], spacing=2, expand=True,
+                              alignment=ft.MainAxisAlignment.CENTER),
+                    row["badge"]
+                ], vertical_alignment=ft.CrossAxisAlignment.CENTER),
+                padding=10,
+                border_radius=8,
+                data=user,
+                on_click=select_user,
+                on_hover=hover_user_row
+            )
+            return row
+        
+        def style_user_row(row, state, current_theme):
+            is_online, unread_count, is_selected, is_dark = state
+            text_color = "#FFFFFF" if is_dark else current_theme["text_color"]
+            row["avatar"].bgcolor = current_theme["primary_color"]
+            row["dot"].bgcolor = "#4CAF50" if is_online else "#9E9E9E"
+            row["name"].color = text_color
+            row["status"].value = "Online" if is_online else "Offline"
+            row["status"].color = text_color
+            row["badge"].visible = unread_count > 0
+            row["badge"].bgcolor = current_theme["primary_color"]
+            row["badge_text"].value = str(unread_count if unread_count < 100 else "99+")
+            row["badge_text"].color = current_theme["button_text_color"]
+            row["item"].bgcolor = current_theme["secondary_color"] if is_selected else current_theme["card_color"]
+            row["state"] = state
+        
+        def update_user_list():
+            """Patch the rows whose online state, unread count or selection changed"""
+            theme_mode = "dark" if self.is_dark_theme else "light"
+            current_theme = self.theme[theme_mode]
+            # Presence and messages change the roster from the comm thread
+            with self.roster.lock:
+                self.roster.select(self.chat_with)
+                changed = self.roster.take_changes()
+                if self.roster.order_changed:
+                    self.roster.order_changed = False
+                    for user in list(self.user_rows):
+                        if user not in self.roster.users or user == self.current_user:
+                            del self.user_rows[user]
+                    for user in self.roster.users:
+                        if user != self.current_user and user not in self.user_rows:
+                            self.user_rows[user] = build_user_row(user)
+                            changed.add(user)
+                    self.user_list.controls[:] = [
+                        self.user_rows[user]["item"] for user in self.roster.users if user in self.user_rows
+                    ]
+                if self.user_rows_dark != self.is_dark_theme:
+                    # Theme toggled: every row needs its colors redone
+                    self.user_rows_dark = self.is_dark_theme
+                    changed = self.user_rows.keys()
+                for user in changed:
+                    row = self.user_rows.get(user)
+                    if row is None:
+                        continue
+                    state = self.roster.row_state(user) + (self.is_dark_theme,)
+                    if state != row["state"]:
+                        style_user_row(row, state, current_theme)
+        
+        # Shapes shared by every bubble; only which one a bubble uses changes
+        radius_sent = ft.border_radius.only(top_left=20, top_right=4, bottom_left=20, bottom_right=20)
+        radius_received = ft.border_radius.only(top_left=4, top_right=20, bottom_left=20, bottom_right=20)
+        margin_sent = ft.margin.only(left=50, right=0)
+        margin_received = ft.margin.only(left=0, right=50)
+        
+        def on_download_click(e):
+            payload = e.control.data
+            self.download_file(payload["name"], payload.get("data"), payload.get("file_id"))
+        
+        def build_message_control(msg, current_theme):
+            # Reuse a bubble that scrolled out of the window if there is one
+            if self.chat_recycled:
+                return fill_message_control(self.chat_recycled.pop(), msg, current_theme)
+            # Text and file rows both exist; fill_message_control shows one of them
+            bubble = ft.Container(
+                content=ft.Column([
+                    ft.Text("", selectable=True, size=14),
+                    ft.Row([
+                        ft.Icon(ft.Icons.ATTACHMENT, size=16),
+                        ft.Text("", selectable=True, size=14),
+                        ft.IconButton(
+                            icon=ft.Icons.DOWNLOAD,
+                            tooltip="Download file",
+                            icon_size=18,
+                            on_click=on_download_click
                         )
-                    ], spacing=2, expand=True, alignment=ft.MainAxisAlignment.CENTER),
-                    badge if badge else ft.Container(width=0)
-                ], vertical_alignment=ft.CrossAxisAlignment.CENTER)
-                
-                user_item = ft.Container(
-                    content=user_row,
-                    padding=10,
-                    border_radius=8,
-                    data=user,
-                    on_click=select_user,
-                    bgcolor=current_theme["card_color"]
+                    ], spacing=5),
+                    ft.Text("", size=12, opacity=0.7)
+                ], spacing=5),
+                padding=15,
+                width=400,
+                shadow=ft.BoxShadow(
+                    spread_radius=0,
+                    blur_radius=4,
+                    color="#20000000",
+                    offset=ft.Offset(0, 2)
                 )
-                if user == self.chat_with:
-                    user_item.bgcolor = current_theme["secondary_color"]
-                else:
-                    user_item.on_hover = lambda e: setattr(e.control, 'bgcolor', 
-                                                         current_theme["secondary_color"] if e.data == "true" else current_theme["card_color"])
-                self.user_list.controls.append(user_item)
+            )
+            control = ft.Container(content=bubble, padding=10)
+            return fill_message_control(control, msg, current_theme)
         
-        def update_chat_view():
-            # Save current position
-            current_scroll = self.chat_scroll_pos
-            last_message_count = len(self.chat_view.controls)
+        def fill_message_control(control, msg, current_theme):
+            """Bind a bubble to a message by setting its properties (also used to restyle or recycle it)"""
+            is_from_me = msg["sender"] == self.current_user
+            message_text = msg["message"]
             
-            self.chat_view.controls.clear()
+            # Skip encrypted messages (they should have been decrypted already)
+            if message_text.startswith("gAAAAAB"):
+                message_text = "[Encrypted message]"
+            
+            # Try to parse JSON for file payload: a file_id reference, or inline data in older messages
+            file_payload = None
+            try:
+                obj = json.loads(message_text)
+                if isinstance(obj, dict) and "name" in obj and ("file_id" in obj or "data" in obj):
+                    file_payload = obj
+            except:
+                pass
+            
+            bubble = control.content
+            text, file_row, time_text = bubble.content.controls
+            file_icon, file_label, download_button = file_row.controls
+            text_color = current_theme["message_text_sent"] if is_from_me else current_theme["message_text_received"]
+            
+            text.visible = file_payload is None
+            file_row.visible = file_payload is not None
+            if file_payload:
+                # File bubble with download button
+                file_color = "#FFFFFF" if is_from_me else current_theme["text_color"]
+                file_icon.color = file_color
+                file_label.value = file_payload["name"]
+                file_label.color = file_color
+                download_button.icon_color = current_theme["primary_color"]
+                download_button.data = file_payload
+            else:
+                # Regular text message
+                text.value = message_text
+                text.color = text_color
+            time_text.value = datetime.fromtimestamp(msg["timestamp"]).strftime("%H:%M")
+            time_text.color = text_color
+            
+            bubble.bgcolor = current_theme["message_sent"] if is_from_me else current_theme["message_received"]
+            bubble.border_radius = radius_sent if is_from_me else radius_received
+            bubble.margin = margin_sent if is_from_me else margin_received
+            control.alignment = ft.alignment.center_right if is_from_me else ft.alignment.center_left
+            control.key = f"msg_{message_key(msg)}"
+            control.data = msg  # Kept so the bubble can be restyled in place
+            return control
+        
+        def update_chat_view(jump_to_latest=False):
+            """Bring the chat view up to date without rebuilding existing bubbles
+
+            Opening a chat (or `jump_to_latest`) loads its latest page; after
+            that only messages newer than the last one shown are fetched and
+            appended, unless the window has been scrolled back into history.
+            """
             theme_mode = "dark" if self.is_dark_theme else "light"
             current_theme = self.theme[theme_mode]
             if not self.chat_with:
+                self.clear_chat_view()
                 self.chat_view.controls.append(
                     ft.Container(
                         content=ft.Text(
@@ -898,113 +1048,151 @@ class OfficeMessenger:
             self.chat_header.value = f"Chat with {self.chat_with}"
             self.chat_header.color = current_theme["text_color"]
             
-            messages = self.db.get_messages(self.current_user, self.chat_with)
+            if jump_to_latest and self.chat_has_newer:
+                self.chat_loaded_with = None
+            if self.chat_loaded_with != self.chat_with or self.chat_newest_ts is None:
+                # New chat - load only the most recent page of history
+                self.clear_chat_view()
+                messages = self.db.get_messages(self.current_user, self.chat_with, limit=self.HISTORY_PAGE_SIZE)
+                self.chat_has_more = len(messages) == self.HISTORY_PAGE_SIZE
+                self.chat_loaded_with = self.chat_with
+                if messages:
+                    self.chat_oldest_ts = messages[0]["timestamp"]
+            elif self.chat_has_newer:
+                # Scrolled back into history; new messages show up when the user scrolls down
+                self.chat_view.auto_scroll = False
+                return
+            else:
+                # Refresh - only messages at or after the newest one shown
+                messages = self.db.iter_messages(self.current_user, self.chat_with, since=self.chat_newest_ts)
             
-            # Add messages to chat view
+            added = append_bubbles(messages, current_theme)
+            trim_window(from_top=True)
+            # New messages scroll to the bottom; otherwise leave the position alone
+            self.chat_view.auto_scroll = added > 0
+        
+        def append_bubbles(messages, current_theme, limit=None):
+            """Append bubbles for messages not on screen yet; returns how many were added"""
+            added = 0
             for msg in messages:
-                is_from_me = msg["sender"] == self.current_user
-                message_text = msg["message"]
-                
-                # Skip encrypted messages (they should have been decrypted already)
-                if message_text.startswith("gAAAAAB"):
-                    message_text = "[Encrypted message]"
-                
-                # Try to parse JSON for file payload
-                file_payload = None
-                try:
-                    obj = json.loads(message_text)
-                    if isinstance(obj, dict) and "name" in obj and "data" in obj:
-                        file_payload = obj
-                except:
-                    pass
-                if file_payload:
-                    file_name = file_payload["name"]
-                    file_data = file_payload["data"]
-                    # File bubble with download button
-                    bubble_content = ft.Row([
-                        ft.Icon(ft.Icons.ATTACHMENT, color="#FFFFFF" if is_from_me else current_theme["text_color"], size=16),
-                        ft.Text(
-                            file_name,
-                            selectable=True,
-                            color="#FFFFFF" if is_from_me else current_theme["text_color"],
-                            size=14
-                        ),
-                        ft.IconButton(
-                            icon=ft.Icons.DOWNLOAD,
-                            tooltip="Download file",
-                            icon_color=current_theme["primary_color"],
-                            icon_size=18,
-                            on_click=lambda e, fn=file_name, fd=file_data: self.download_file(fn, fd)
-                        )
-                    ], spacing=5)
-                    bubble = ft.Column([
-                        bubble_content,
-                        ft.Text(
-                            datetime.fromtimestamp(msg["timestamp"]).strftime("%H:%M"),
-                            size=12,
-                            color=current_theme["message_text_sent"] if is_from_me else current_theme["message_text_received"],
-                            opacity=0.7
-                        )
-                    ], spacing=5)
-                else:
-                    # Regular text message
-                    bubble = ft.Column([
-                        ft.Text(
-                            message_text,
-                            selectable=True,
-                            color=current_theme["message_text_sent"] if is_from_me else current_theme["message_text_received"],
-                            size=14
-                        ),
-                        ft.Text(
-                            datetime.fromtimestamp(msg["timestamp"]).strftime("%H:%M"),
-                            size=12,
-                            color=current_theme["message_text_sent"] if is_from_me else current_theme["message_text_received"],
-                            opacity=0.7
-                        )
-                    ], spacing=5)
-                message_bubble = ft.Container(
-                    content=bubble,
-                    padding=15,
-                    border_radius=ft.border_radius.only(
-                        top_left=20 if is_from_me else 4,
-                        top_right=4 if is_from_me else 20,
-                        bottom_left=20,
-                        bottom_right=20
-                    ),
-                    bgcolor=current_theme["message_sent"] if is_from_me else current_theme["message_received"],
-                    width=400,
-                    margin=ft.margin.only(left=50 if is_from_me else 0, right=0 if is_from_me else 50),
-                    shadow=ft.BoxShadow(
-                        spread_radius=0,
-                        blur_radius=4,
-                        color="#20000000",
-                        offset=ft.Offset(0, 2)
-                    )
+                key = message_key(msg)
+                if key in self.chat_controls:
+                    continue
+                if limit is not None and added == limit:
+                    break
+                control = build_message_control(msg, current_theme)
+                self.chat_controls[key] = control
+                self.chat_view.controls.append(control)
+                self.chat_newest_ts = msg["timestamp"]
+                added += 1
+            return added
+        
+        def trim_window(from_top):
+            """Recycle bubbles beyond CHAT_WINDOW_SIZE from the end the user is moving away from"""
+            excess = len(self.chat_view.controls) - self.CHAT_WINDOW_SIZE
+            if excess <= 0:
+                return
+            if from_top:
+                dropped = self.chat_view.controls[:excess]
+                del self.chat_view.controls[:excess]
+                self.chat_oldest_ts = self.chat_view.controls[0].data["timestamp"]
+                self.chat_has_more = True
+            else:
+                dropped = self.chat_view.controls[-excess:]
+                del self.chat_view.controls[-excess:]
+                self.chat_newest_ts = self.chat_view.controls[-1].data["timestamp"]
+                self.chat_has_newer = True
+            for control in dropped:
+                self.chat_controls.pop(message_key(control.data), None)
+                if len(self.chat_recycled) < self.HISTORY_PAGE_SIZE:
+                    self.chat_recycled.append(control)
+        
+        def restyle_chat_view(current_theme):
+            """Recolor the bubbles on screen for a theme change, keeping the controls in place"""
+            for control in self.chat_controls.values():
+                fill_message_control(control, control.data, current_theme)
+        
+        def load_older_messages():
+            """Prepend the page of history before the oldest loaded message"""
+            if self.loading_older or not self.chat_has_more or not self.chat_with or self.chat_oldest_ts is None:
+                return
+            self.loading_older = True
+            try:
+                theme_mode = "dark" if self.is_dark_theme else "light"
+                current_theme = self.theme[theme_mode]
+                messages = self.db.get_messages(
+                    self.current_user, self.chat_with,
+                    before=self.chat_oldest_ts, limit=self.HISTORY_PAGE_SIZE
                 )
-                self.chat_view.controls.append(
-                    ft.Container(
-                        content=message_bubble,
-                        alignment=ft.alignment.center_right if is_from_me else ft.alignment.center_left,
-                        padding=10
-                    )
+                self.chat_has_more = len(messages) == self.HISTORY_PAGE_SIZE
+                if not messages:
+                    return
+                self.chat_oldest_ts = messages[0]["timestamp"]
+                anchor_key = self.chat_view.controls[0].key if self.chat_view.controls else None
+                self.chat_view.auto_scroll = False
+                older = []
+                for msg in messages:
+                    key = message_key(msg)
+                    if key not in self.chat_controls:
+                        self.chat_controls[key] = build_message_control(msg, current_theme)
+                        older.append(self.chat_controls[key])
+                self.chat_view.controls[0:0] = older
+                trim_window(from_top=False)
+                # scroll_to needs the new bubbles on the client first
+                self.frames.flush_now()
+                # Keep the message the user was looking at in place
+                if anchor_key:
+                    self.chat_view.scroll_to(key=anchor_key, duration=0)
+            finally:
+                self.loading_older = False
+        
+        def load_newer_messages():
+            """Append the page after the newest bubble when the window is behind the live end"""
+            if self.loading_older or not self.chat_has_newer or not self.chat_with:
+                return
+            self.loading_older = True
+            try:
+                theme_mode = "dark" if self.is_dark_theme else "light"
+                current_theme = self.theme[theme_mode]
+                anchor_key = self.chat_view.controls[-1].key if self.chat_view.controls else None
+                # `since` is inclusive, so bubbles sharing the newest timestamp come back too
+                overlap = 0
+                for control in reversed(self.chat_view.controls):
+                    if control.data["timestamp"] != self.chat_newest_ts:
+                        break
+                    overlap += 1
+                # One extra message tells us whether this page reaches the live end
+                newer = islice(
+                    self.db.iter_messages(self.current_user, self.chat_with, since=self.chat_newest_ts),
+                    overlap + self.HISTORY_PAGE_SIZE + 1
                 )
-            
-            # Scroll management
-            if len(messages) > 0:
-                if last_message_count == 0:
-                    # First load - scroll to bottom
-                    self.chat_view.auto_scroll = True
-                elif len(self.chat_view.controls) > last_message_count:
-                    # New messages added - scroll to bottom
-                    self.chat_view.auto_scroll = True 
-                else:
-                    # No new messages - maintain position
-                    self.chat_view.auto_scroll = False
-                    # Restore scroll position immediately
-                    self.restore_scroll_position(current_scroll)
+                newer = [msg for msg in newer if message_key(msg) not in self.chat_controls]
+                self.chat_has_newer = len(newer) > self.HISTORY_PAGE_SIZE
+                self.chat_view.auto_scroll = False
+                append_bubbles(newer, current_theme, limit=self.HISTORY_PAGE_SIZE)
+                trim_window(from_top=True)
+                self.frames.flush_now()
+                if anchor_key:
+                    self.chat_view.scroll_to(key=anchor_key, duration=0)
+            finally:
+                self.loading_older = False
+        
+        def show_received_message(msg):
+            """Append a message just received in the open chat without reading it back from storage"""
+            if self.chat_loaded_with != self.chat_with or self.chat_has_newer:
+                # Not at the live end; it is loaded with the rest when the user gets there
+                return
+            theme_mode = "dark" if self.is_dark_theme else "light"
+            added = append_bubbles([msg], self.theme[theme_mode])
+            trim_window(from_top=True)
+            self.chat_view.auto_scroll = added > 0
         
         self.update_users = update_user_list
         self.update_chat = update_chat_view
+        self.show_received = show_received_message
+        self.restyle_chat = restyle_chat_view
+        self.load_older = load_older_messages
+        self.load_newer = load_newer_messages
         
     def insert_emoji(self, emoji_char):
         """Insert emoji at cursor position in message field"""
@@ -1022,7 +1210,7 @@ class OfficeMessenger:
         self.message_field.cursor_index = cursor_position + len(emoji_char)
         
         # Don't hide emoji grid after selection to allow multiple emoji selection
-        self.page.update()
+        self.request_update()
     
     def update_login_screen_theme(self, current_theme):
         """Update login screen with current theme colors"""
@@ -1131,16 +1319,9 @@ class OfficeMessenger:
                                         self.message_field.bgcolor = current_theme["card_color"]
                                         self.message_field.color = current_theme["text_color"]
         
-        # Update user list items
-        if hasattr(self, 'user_list'):
-            for user_item in self.user_list.controls:
-                if isinstance(user_item, ft.Container):
-                    if user_item.data == self.chat_with:
-                        user_item.bgcolor = current_theme["secondary_color"]
-                    else:
-                        user_item.bgcolor = current_theme["card_color"]
-                        user_item.on_hover = lambda e: setattr(e.control, 'bgcolor',
-                            current_theme["secondary_color"] if e.data == "true" else current_theme["card_color"])
+        # Recolor user list rows in place
+        if hasattr(self, 'update_users'):
+            self.update_users()
         
         # Update chat header
         if hasattr(self, 'chat_header'):
@@ -1154,6 +1335,11 @@ class OfficeMessenger:
                     current_theme["secondary_color"] if e.data == "true" else current_theme["card_color"])
 
     async def handle_received_message(self, data):
+        """Store and show an incoming message
+        
+        Returns an awaitable that yields True once the message is on disk;
+        the client only acks it to the server after that.
+        """
         sender = data.get("sender")
         content = data.get("content")
         msg_id = data.get("msg_id")
@@ -1161,7 +1347,10 @@ class OfficeMessenger:
         # Skip if we've already processed this message
         if msg_id and msg_id in self.sent_message_ids:
             print(f"[DEBUG] Skipping duplicate message with ID: {msg_id}")
-            return
+            # Its first copy may still be waiting for the group commit
+            return asyncio.to_thread(self.db.writer.submit([]).wait)
+        
+        saved = None
         
         if sender and content:
             # Add message ID to our tracking set if it has one
@@ -1171,28 +1360,37 @@ class OfficeMessenger:
             # For messages from other users to me, save them
             if sender != self.current_user:
                 print(f"[DEBUG] Received message from {sender}: {content}")
-                self.db.save_message(sender, self.current_user, content)
+                # Don't block the comm loop on disk; a reconnect backlog is group-committed
+                saved = self.db.save_message(sender, self.current_user, content, msg_id, wait=False)
                 if self.chat_with != sender:
                     # Increment unread count
-                    self.unseen_messages[sender] = self.unseen_messages.get(sender, 0) + 1
+                    self.roster.add_unread(sender)
                     # Play notification sound
                     self.play_notification()
             
             # Update UI if we're in the relevant chat
             if self.chat_with == sender:
-                self.update_chat()
-                self.page.update()
+                # update_chat() would wait for the group commit, stalling the comm loop
+                if saved is not None and saved.records:
+                    self.show_received(self.db.as_message(saved.records[0]))
+                self.request_update()
             else:
                 # Just update the user list to show unread count
                 self.update_users()
-                self.page.update()
+                self.request_update()
+        if saved is not None:
+            return asyncio.to_thread(saved.wait)
     
     async def handle_status_update(self, data):
-        # data: {'type': 'status', 'online': [...]}
+        # data: {'type': 'status', 'online': [...]} snapshot, or
+        #       {'type': 'status', 'event': 'join'|'leave', 'user': ...} delta
         # Highlight online users in the user list
-        self.online_users = set(data.get('online', []))
+        if 'online' in data:
+            self.roster.set_online(data['online'])
+        elif data.get('event') in ('join', 'leave'):
+            self.roster.set_presence(data.get('user'), data['event'] == 'join')
         self.update_users()
-        self.page.update()
+        self.request_update()
     
     async def handle_typing_update(self, data):
         # data: {'type': 'typing', 'users': [...]}
@@ -1212,7 +1410,7 @@ class OfficeMessenger:
                             for col_control in control.content.controls:
                                 if isinstance(col_control, ft.Container) and col_control.key == "typing_indicator":
                                     col_control.visible = True
-                                    self.page.update()
+                                    self.request_update()
                                     return
                 else:
                     # Hide typing indicator if user stopped typing
@@ -1221,9 +1419,14 @@ class OfficeMessenger:
                             for col_control in control.content.controls:
                                 if isinstance(col_control, ft.Container) and col_control.key == "typing_indicator":
                                     col_control.visible = False
-                                    self.page.update()
+                                    self.request_update()
                                     return
     
+    def request_update(self):
+        """Ask for a page refresh on the next frame; safe from any thread"""
+        if self.frames:
+            self.frames.request()
+    
     def show_login_screen(self):
         self.page.controls.clear()
         self.page.add(self.login_screen)
@@ -1231,6 +1434,8 @@ class OfficeMessenger:
     def show_chat_screen(self):
         self.page.controls.clear()
         self.page.add(self.chat_screen)
+        # The only full read of the user table; later arrivals join the roster via presence
+        self.roster.set_users(user for user in self.db.get_all_users() if user != self.current_user)
         self.update_users()
     
     @property
@@ -1238,7 +1443,7 @@ class OfficeMessenger:
         # Get the page from any control
         return self.login_screen.page or self.chat_screen.page
 
-    def download_file(self, file_name, file_data=None):
+    def download_file(self, file_name, file_data=None, file_id=None):
         # Use FilePicker to save a dummy file with the same name
         def on_save(e):
             if e.path:
@@ -1248,7 +1453,16 @@ class OfficeMessenger:
                 if os.path.basename(target_path) != file_name:
                     target_path = os.path.join(save_dir, file_name)
                 # Write actual content or dummy fallback
-                if file_data:
+                if file_id and self.comm_client and self.comm_loop:
+                    # Streamed from the server in the background, resuming any earlier attempt
+                    asyncio.run_coroutine_threadsafe(
+                        self.comm_client.download_file(
+                            file_id, target_path,
+                            on_progress=self.transfer_progress(f"Downloading {file_name}")
+                        ),
+                        self.comm_loop
+                    )
+                elif file_data:
                     try:
                         content = base64.b64decode(file_data)
                         with open(target_path, 'wb') as f:
@@ -1271,10 +1485,82 @@ class OfficeMessenger:
         if picker not in self.page.overlay:
             self.page.overlay.append(picker)
         # Push overlay change and invoke save dialog with correct default filename
-        self.page.update()
+        self.request_update()
         # Open save dialog and suggest the correct filename
         picker.save_file(file_name=file_name)
 
+    async def send_file(self, recipient, path, name):
+        """Upload a file in chunks, then send and store a message that references it
+
+        Hashing and reading run on the client's worker threads, so neither
+        the UI nor the websocket waits on the disk; the attach button
+        cancels the upload meanwhile.
+        """
+        cancel = threading.Event()
+        with self.uploads_lock:
+            self.active_uploads.add(cancel)
+        self.set_attach_cancels(True)
+        try:
+            try:
+                file_id = await self.comm_client.create_upload(
+                    path, on_progress=self.transfer_progress(f"Preparing {name}"), cancel=cancel
+                )
+            except TransferCancelled:
+                raise
+            except Exception as e:
+                print(f"Could not start upload of {name}: {e}")
+                file_id = None
+            for attempt in range(3 if file_id else 0):
+                try:
+                    # Retries resume from whatever the server already has
+                    await self.comm_client.upload_file(
+                        path, on_progress=self.transfer_progress(f"Uploading {name}"), file_id=file_id, cancel=cancel
+                    )
+                    break
+                except TransferCancelled:
+                    raise
+                except Exception as e:
+                    print(f"Upload of {name} failed (attempt {attempt + 1}): {e}")
+            else:
+                self.message_field.hint_text = f"Could not upload {name}"
+                self.request_update()
+                return
+        except TransferCancelled:
+            self.message_field.hint_text = f"Upload of {name} cancelled"
+            self.request_update()
+            return
+        finally:
+            with self.uploads_lock:
+                self.active_uploads.discard(cancel)
+                uploading = bool(self.active_uploads)
+            self.set_attach_cancels(uploading)
+        message = json.dumps({"name": name, "file_id": file_id, "size": os.path.getsize(path)})
+        msg_id = f"{self.current_user}_{recipient}_{time.time()}"
+        self.sent_message_ids.add(msg_id)
+        await self.comm_client.send_message(recipient, message, msg_id)
+        self.db.save_message(self.current_user, recipient, message, msg_id, wait=False)
+        self.message_field.hint_text = "Type your message..."
+        if self.chat_with == recipient:
+            self.update_chat(jump_to_latest=True)
+        self.request_update()
+
+    def set_attach_cancels(self, uploading):
+        """Turn the attach button into a cancel button while uploads run"""
+        self.attach_button.icon = ft.Icons.CLOSE if uploading else ft.Icons.ATTACH_FILE
+        self.attach_button.tooltip = "Cancel upload" if uploading else "Attach file"
+        self.request_update()
+
+    def transfer_progress(self, label):
+        """Progress callback that shows whole-percent steps in the message field hint"""
+        last = [-1]
+        def on_progress(done, total):
+            percent = int(done * 100 / total) if total else 100
+            if percent != last[0]:
+                last[0] = percent
+                self.message_field.hint_text = f"{label}: {percent}%" if percent < 100 else "Type your message..."
+                self.request_update()
+        return on_progress
+
     def send_message(self, recipient, content):
         if self.comm_client and self.comm_loop:
             asyncio.run_coroutine_threadsafe(
@@ -1286,7 +1572,7 @@ class OfficeMessenger:
         if self.comm_client and self.comm_loop and self.chat_with:
             # Send typing status immediately
             asyncio.run_coroutine_threadsafe(
-                self.comm_client.send_typing(is_typing),
+                self.comm_client.send_typing(is_typing, self.chat_with),
                 self.comm_loop
             )
             # Optionally clear typing after 3 seconds using threading.Timer
@@ -1298,21 +1584,31 @@ class OfficeMessenger:
                     except:
                         pass
                 # Schedule to clear typing status
+                chat_with = self.chat_with
                 timer = threading.Timer(3, lambda: asyncio.run_coroutine_threadsafe(
-                    self.comm_client.send_typing(False), self.comm_loop))
+                    self.comm_client.send_typing(False, chat_with), self.comm_loop))
                 timer.daemon = True
                 timer.start()
                 self.typing_timeout = timer
 
     def on_chat_scroll(self, e):
-        """Track scroll position to restore it after updates"""
+        """Track scroll position and slide the message window near either end"""
         self.chat_scroll_pos = e.pixels
+        if e.pixels is not None and hasattr(self, 'load_older'):
+            if e.pixels - (e.min_scroll_extent or 0) <= self.HISTORY_LOAD_THRESHOLD:
+                self.load_older()
+            elif e.max_scroll_extent is not None and e.max_scroll_extent - e.pixels <= self.HISTORY_LOAD_THRESHOLD:
+                self.load_newer()
 
-    def restore_scroll_position(self, current_scroll):
-        """Restore chat scroll position directly"""
-        if hasattr(self, 'chat_view'):
-            self.chat_view.auto_scroll = False
-            self.chat_view.scroll_to(current_scroll)
+    def clear_chat_view(self):
+        """Drop every bubble and the history cursors, e.g. when switching chats"""
+        self.chat_view.controls.clear()
+        self.chat_controls.clear()
+        self.chat_loaded_with = None
+        self.chat_oldest_ts = None
+        self.chat_newest_ts = None
+        self.chat_has_more = False
+        self.chat_has_newer = False
 
     def play_notification(self):
         """Play notification sound if file exists"""
@@ -0,0 +1,233 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+from storage import iter_jsonl
+
+
+class _RecipientQueue:
+    def __init__(self, log_path):
+        self.log_path = log_path
+        self.memory = OrderedDict()  # msg_id -> entry, oldest first (head of the queue)
+        self.on_disk_only = 0  # Entries past the memory bound, kept only in the log
+        self.memory_bytes = 0
+        self.tombstones = 0  # Ack/drop lines in the log since the last compaction
+        self.pending_ids = set()  # msg_id of every pending entry, in memory or only on disk
+
+    @property
+    def total(self):
+        return len(self.memory) + self.on_disk_only
+
+
+class OfflineQueue:
+    """Per-recipient delivery queues for the comm server
+
+    Every queued message is appended to a per-recipient log under
+    `spool_dir`, so nothing is lost on restart. Only the first
+    `max_in_memory` entries per recipient are kept in memory; the rest
+    stay on disk and are loaded as earlier ones are acknowledged.
+    Queues are capped at `max_per_recipient` (oldest dropped first) and
+    entries older than `ttl` seconds expire; `on_discard(recipient, msg)`
+    is called for messages dropped or expired without being delivered.
+    """
+
+    def __init__(self, spool_dir="offline_queue", max_in_memory=200,
+                 max_per_recipient=5000, ttl=7 * 24 * 3600, compact_threshold=500, on_discard=None):
+        self.spool_dir = spool_dir
+        self.max_in_memory = max_in_memory
+        self.max_per_recipient = max_per_recipient
+        self.ttl = ttl
+        self.compact_threshold = compact_threshold
+        self.on_discard = on_discard
+        self.queues = {}
+        self.stats = {"queued": 0, "acked": 0, "dropped": 0, "expired": 0}
+        os.makedirs(spool_dir, exist_ok=True)
+        self._load()
+
+    def _log_path(self, recipient):
+        name = hashlib.sha1(recipient.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.spool_dir, name + ".jsonl")
+
+    def _queue(self, recipient):
+        if recipient not in self.queues:
+            self.queues[recipient] = _RecipientQueue(self._log_path(recipient))
+        return self.queues[recipient]
+
+    def _load(self):
+        """Rebuild queues from the spool logs after a restart"""
+        for file_name in os.listdir(self.spool_dir):
+            if not file_name.endswith(".jsonl"):
+                continue
+            recipient = None
+            for record in iter_jsonl(os.path.join(self.spool_dir, file_name)):
+                recipient = record.get("recipient")
+                if recipient:
+                    break
+            if recipient is None:
+                os.remove(os.path.join(self.spool_dir, file_name))
+                continue
+            queue = self._queue(recipient)
+            self._refill(queue, recipient)
+            if queue.total == 0:
+                os.remove(queue.log_path)
+                del self.queues[recipient]
+
+    def _append_log(self, queue, record):
+        with open(queue.log_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def _read_pending(self, queue):
+        """Stream unacknowledged entries from a recipient's log, oldest first, once per msg_id"""
+        removed = set()
+        for record in iter_jsonl(queue.log_path):
+            if "ack" in record:
+                removed.add(record["ack"])
+        for record in iter_jsonl(queue.log_path):
+            if "msg" in record and record["msg"].get("msg_id") not in removed:
+                # Logs written before push() checked the disk can hold repeats
+                removed.add(record["msg"].get("msg_id"))
+                yield record
+
+    def _refill(self, queue, recipient):
+        """Pull entries that only live on disk into memory; returns the new entries"""
+        added = []
+        expired = []
+        on_disk_only = 0
+        pending_ids = set(queue.memory)
+        cutoff = time.time() - self.ttl
+        for record in self._read_pending(queue):
+            msg_id = record["msg"]["msg_id"]
+            if msg_id in queue.memory:
+                continue
+            if record["queued_at"] < cutoff:
+                expired.append(record["msg"])
+                continue
+            pending_ids.add(msg_id)
+            if len(queue.memory) < self.max_in_memory:
+                entry = {"msg": record["msg"], "queued_at": record["queued_at"],
+                         "size": len(json.dumps(record["msg"]))}
+                queue.memory[msg_id] = entry
+                queue.memory_bytes += entry["size"]
+                added.append(entry["msg"])
+            else:
+                on_disk_only += 1
+        queue.on_disk_only = on_disk_only
+        queue.pending_ids = pending_ids
+        for msg in expired:
+            self._append_log(queue, {"recipient": recipient, "ack": msg["msg_id"]})
+            self._discarded(recipient, msg)
+        queue.tombstones += len(expired)
+        self.stats["expired"] += len(expired)
+        return added
+
+    def _discarded(self, recipient, msg):
+        if self.on_discard:
+            try:
+                self.on_discard(recipient, msg)
+            except Exception as e:
+                print(f"Error in offline queue discard hook: {e}")
+
+    def push(self, recipient, msg):
+        """Queue a message until the recipient acknowledges it
+
+        Returns False if the msg_id is already pending (e.g. a sender's
+        retry), in which case nothing changes.
+        """
+        queue = self._queue(recipient)
+        if msg["msg_id"] in queue.pending_ids:
+            return False
+        # Bound the queue by dropping the oldest entries
+        while queue.total >= self.max_per_recipient:
+            if not queue.memory:
+                self._refill(queue, recipient)
+                continue
+            old_id = next(iter(queue.memory))
+            self._discarded(recipient, self._remove(recipient, queue, old_id))
+            self.stats["dropped"] += 1
+        self._top_up(queue, recipient)
+        now = time.time()
+        self._append_log(queue, {"recipient": recipient, "msg": msg, "queued_at": now})
+        queue.pending_ids.add(msg["msg_id"])
+        self.stats["queued"] += 1
+        if queue.on_disk_only == 0 and len(queue.memory) < self.max_in_memory:
+            entry = {"msg": msg, "queued_at": now, "size": len(json.dumps(msg))}
+            queue.memory[msg["msg_id"]] = entry
+            queue.memory_bytes += entry["size"]
+        else:
+            # Spilled: it stays on disk until earlier entries are acknowledged
+            queue.on_disk_only += 1
+        return True
+
+    def pending(self, recipient):
+        """Messages currently held in memory for a recipient, oldest first"""
+        queue = self.queues.get(recipient)
+        if queue is None:
+            return []
+        return [entry["msg"] for entry in queue.memory.values()]
+
+    def ack(self, recipient, msg_id):
+        """Remove a delivered message; returns messages newly loaded from disk"""
+        queue = self.queues.get(recipient)
+        if queue is None or msg_id not in queue.memory:
+            return []
+        self._remove(recipient, queue, msg_id)
+        self.stats["acked"] += 1
+        if queue.total == 0:
+            self._drop_queue(recipient, queue)
+            return []
+        return self._top_up(queue, recipient)
+
+    def _top_up(self, queue, recipient):
+        # Reload in batches rather than reading the log on every ack
+        if queue.on_disk_only and len(queue.memory) <= self.max_in_memory // 2:
+            return self._refill(queue, recipient)
+        return []
+
+    def _remove(self, recipient, queue, msg_id):
+        entry = queue.memory.pop(msg_id)
+        queue.memory_bytes -= entry["size"]
+        queue.pending_ids.discard(msg_id)
+        self._append_log(queue, {"recipient": recipient, "ack": msg_id})
+        queue.tombstones += 1
+        if queue.tombstones >= self.compact_threshold:
+            self._compact(recipient, queue)
+        return entry["msg"]
+
+    def _compact(self, recipient, queue):
+        """Rewrite a recipient's log with only the entries still pending"""
+        tmp_path = queue.log_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in self._read_pending(queue):
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+        os.replace(tmp_path, queue.log_path)
+        queue.tombstones = 0
+
+    def _drop_queue(self, recipient, queue):
+        try:
+            os.remove(queue.log_path)
+        except FileNotFoundError:
+            pass
+        del self.queues[recipient]
+
+    def expire(self):
+        """Drop in-memory entries older than the TTL; disk entries expire as they load"""
+        cutoff = time.time() - self.ttl
+        for recipient, queue in list(self.queues.items()):
+            expired = [msg_id for msg_id, entry in queue.memory.items() if entry["queued_at"] < cutoff]
+            for msg_id in expired:
+                self._discarded(recipient, self._remove(recipient, queue, msg_id))
+                self.stats["expired"] += 1
+            self._top_up(queue, recipient)
+            if queue.total == 0:
+                self._drop_queue(recipient, queue)
+
+    def metrics(self):
+        return {
+            "recipients": len(self.queues),
+            "in_memory": sum(len(q.memory) for q in self.queues.values()),
+            "in_memory_bytes": sum(q.memory_bytes for q in self.queues.values()),
+            "on_disk_only": sum(q.on_disk_only for q in self.queues.values()),
+            **self.stats
+        }
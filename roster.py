@@ -0,0 +1,87 @@
+import threading
+
+
+class Roster:
+    """In-memory model behind the user list
+
+    Holds the other users in display order with their online state, unread
+    count and which one is selected. Every mutation records the users whose
+    row would look different, so the view can patch just those rows
+    (take_changes()) instead of rebuilding the list.
+
+    The comm thread and the Flet thread both update it; `lock` guards every
+    mutation and is held by the view while it patches rows.
+    """
+
+    def __init__(self):
+        self.users = []
+        self.online = set()
+        self.unread = {}
+        self.selected = None
+        self.order_changed = False
+        self._changed = set()
+        self.lock = threading.RLock()
+
+    def set_users(self, users):
+        """Replace the user list (e.g. after login); keeps presence and unread counts"""
+        with self.lock:
+            users = list(users)
+            if users != self.users:
+                self.users = users
+                self.order_changed = True
+                self._changed.update(users)
+
+    def ensure(self, user):
+        """Add a user the roster hasn't seen yet (someone who registered after login)"""
+        with self.lock:
+            if user and user not in self.users:
+                self.users.append(user)
+                self.order_changed = True
+                self._changed.add(user)
+
+    def set_online(self, users):
+        """Apply a presence snapshot"""
+        with self.lock:
+            users = set(users)
+            self._changed.update(users ^ self.online)
+            self.online = users
+            for user in users:
+                self.ensure(user)
+
+    def set_presence(self, user, is_online):
+        """Apply a join/leave delta"""
+        with self.lock:
+            if is_online and user not in self.online:
+                self.online.add(user)
+                self.ensure(user)
+                self._changed.add(user)
+            elif not is_online and user in self.online:
+                self.online.discard(user)
+                self._changed.add(user)
+
+    def add_unread(self, user):
+        with self.lock:
+            self.ensure(user)
+            self.unread[user] = self.unread.get(user, 0) + 1
+            self._changed.add(user)
+
+    def clear_unread(self, user):
+        with self.lock:
+            if self.unread.pop(user, 0):
+                self._changed.add(user)
+
+    def select(self, user):
+        with self.lock:
+            if user != self.selected:
+                self._changed.update(u for u in (self.selected, user) if u)
+                self.selected = user
+
+    def row_state(self, user):
+        """What a user's row shows: (is_online, unread_count, is_selected)"""
+        return (user in self.online, self.unread.get(user, 0), user == self.selected)
+
+    def take_changes(self):
+        """Users whose rows need patching since the last call"""
+        with self.lock:
+            changed, self._changed = self._changed, set()
+            return changed
@@ -1,5 +1,7 @@
 import os
 import re
+import hmac
+import hashlib
 from argon2 import PasswordHasher
 from cryptography.fernet import Fernet
 from dotenv import load_dotenv
@@ -46,6 +48,10 @@ class SecurityManager:
         """Decrypt message using Fernet"""
         return self.cipher.decrypt(encrypted_message.encode()).decode()
     
+    def content_digest(self, message):
+        """Keyed hash of a message, comparable without storing plaintext"""
+        return hmac.new(self.encryption_key.encode(), message.encode(), hashlib.sha256).hexdigest()
+    
     def validate_username(self, username):
         """Validate username format"""
         if not username:
@@ -0,0 +1,920 @@
+import hashlib
+import heapq
+import json
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+
+class FileLock:
+    """Exclusive advisory lock on a side file, shared across threads and processes
+
+    The lock is re-entrant within a process. Use file_lock() to get one, so
+    there is a single instance (and file descriptor) per path per process.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def acquire(self):
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            try:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                if os.name == "nt":
+                    while True:
+                        try:
+                            msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                            break
+                        except OSError:
+                            # LK_LOCK gives up after ~10s; keep waiting
+                            continue
+                else:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                self._fd = fd
+            except Exception:
+                self._thread_lock.release()
+                raise
+        self._depth += 1
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            try:
+                if os.name == "nt":
+                    os.lseek(self._fd, 0, os.SEEK_SET)
+                    msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+                else:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+            finally:
+                os.close(self._fd)
+                self._fd = None
+        self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+_file_locks = {}
+_file_locks_guard = threading.Lock()
+
+
+def file_lock(path):
+    """Return the process-wide FileLock for path"""
+    path = os.path.abspath(path)
+    with _file_locks_guard:
+        if path not in _file_locks:
+            _file_locks[path] = FileLock(path)
+        return _file_locks[path]
+
+
+def file_stamp(path):
+    """(inode, size) of a file; changes on every append and every replace"""
+    stat = os.stat(path)
+    return (stat.st_ino, stat.st_size)
+
+
+def conversation_key(user1, user2):
+    """Order-independent key for the conversation between two users"""
+    return ":".join(sorted((user1, user2)))
+
+
+def iter_jsonl(path):
+    """Yield every readable record in a JSON Lines file, skipping torn lines"""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # A crash mid-write can leave a partial last line
+                continue
+
+
+def iter_json_array(path, chunk_size=64 * 1024):
+    """Yield the elements of a top-level JSON array without loading the whole file"""
+    decoder = json.JSONDecoder()
+    read_size = chunk_size
+    with open(path, "r", encoding="utf-8") as f:
+        buf = f.read(chunk_size)
+        eof = not buf
+        pos = 0
+        started = False
+        while True:
+            # Skip whitespace, the opening bracket and separators
+            while pos < len(buf) and (buf[pos].isspace() or buf[pos] == "," or
+                                      (buf[pos] == "[" and not started)):
+                started = started or buf[pos] == "["
+                pos += 1
+            if pos < len(buf) and buf[pos] == "]":
+                return
+            if pos >= len(buf) and eof:
+                return
+            try:
+                if pos >= len(buf):
+                    raise json.JSONDecodeError("Need more data", buf, pos)
+                item, end = decoder.raw_decode(buf, pos)
+                # A value that ends exactly at the buffer edge may be cut short
+                if end == len(buf) and not eof:
+                    raise json.JSONDecodeError("Need more data", buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # Each retry re-parses the record from its start, so read twice as
+                # much every time; a huge inline attachment then costs O(size), not O(size^2)
+                chunk = f.read(read_size)
+                read_size *= 2
+                eof = not chunk
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            read_size = chunk_size
+            yield item
+            pos = end
+
+
+def iter_matching(records, user1, user2=None, before=None, since=None):
+    """Yield records from user1's conversations (with user2 if given) with since <= timestamp < before"""
+    for record in records:
+        sender = record.get("sender")
+        receiver = record.get("receiver")
+        if user2:
+            if not ((sender == user1 and receiver == user2) or
+                    (sender == user2 and receiver == user1)):
+                continue
+        elif sender != user1 and receiver != user1:
+            continue
+        timestamp = record.get("timestamp", 0)
+        if before is not None and timestamp >= before:
+            continue
+        if since is not None and timestamp < since:
+            continue
+        yield record
+
+
+def select_records(records, user1, user2=None, before=None, since=None, limit=None):
+    """Filter records like iter_matching and keep only the newest `limit`, oldest first"""
+    matches = deque(iter_matching(records, user1, user2, before, since), maxlen=limit)
+    return sorted(matches, key=lambda r: r.get("timestamp", 0))
+
+
+def write_json_atomic(path, data):
+    """Write JSON to a temp file, fsync it and rename it over path"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class JsonlMessageStore:
+    """Append-only message log stored as JSON Lines (one record per line)
+
+    Writers in other processes are serialized with an advisory lock on
+    `<path>.lock`. Readers take no lock: they skip a torn last line, and
+    compaction swaps the file with an atomic rename. A msg_id is written
+    at most once, even when several processes share the log.
+    """
+
+    def __init__(self, path, legacy_path=None, fsync_interval=0.5,
+                 compact_interval=300, compact_threshold=1000, background=True):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.compact_interval = compact_interval
+        self.compact_threshold = compact_threshold
+        self._lock = threading.RLock()
+        self._file_lock = file_lock(path + ".lock")
+        self._dirty = False
+        self._msg_ids = set()  # Every msg_id in the log up to _indexed
+        self._indexed = None  # (inode, byte offset) the msg_id index covers
+        self._appends_since_compact = 0
+        self._last_compact = time.time()
+        self._stop = threading.Event()
+
+        with self._file_lock:
+            # Convert the old single-array messages.json on first start
+            if legacy_path and os.path.exists(legacy_path) and not os.path.exists(path):
+                self._import_legacy(legacy_path)
+
+            if not os.path.exists(path):
+                open(path, "a").close()
+
+            self._file = open(path, "a", encoding="utf-8")
+
+        # Background thread for batched fsync and periodic compaction.
+        # Shards of a ShardedMessageStore share one maintenance thread instead.
+        if background:
+            self._worker = threading.Thread(target=self._background, daemon=True)
+            self._worker.start()
+
+    def _import_legacy(self, legacy_path):
+        """Rewrite a legacy JSON array file as a JSON Lines log"""
+        try:
+            count = self._write_records(iter_json_array(legacy_path))
+        except Exception as e:
+            print(f"Error reading legacy message file: {e}")
+            return
+        os.replace(legacy_path, legacy_path + ".migrated")
+        print(f"Migrated {count} messages from {legacy_path} to {self.path}")
+
+    def _write_records(self, records):
+        """Atomically replace the log with the given records"""
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        count = 0
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+                count += 1
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        return count
+
+    def append(self, record):
+        """Append one record; it is fsynced by the background thread"""
+        self.append_many([record])
+
+    def append_many(self, records):
+        """Append several records with a single write, skipping msg_ids already in the log
+
+        Returns the file stamps from just before and just after the write,
+        and the records that were actually written.
+        """
+        lines = [(record, json.dumps(record, separators=(",", ":")) + "\n") for record in records]
+        with self._lock, self._file_lock:
+            self._reopen_if_replaced()
+            self._index_msg_ids()
+            written = []
+            data = []
+            for record, line in lines:
+                msg_id = record.get("msg_id")
+                if msg_id:
+                    if msg_id in self._msg_ids:
+                        continue
+                    self._msg_ids.add(msg_id)
+                written.append(record)
+                data.append(line)
+            stat = os.fstat(self._file.fileno())
+            if data:
+                self._file.write("".join(data))
+                self._file.flush()
+                self._dirty = True
+                self._appends_since_compact += len(written)
+            size_after = os.fstat(self._file.fileno()).st_size
+            self._indexed = (stat.st_ino, size_after)
+            return (stat.st_ino, stat.st_size), (stat.st_ino, size_after), written
+
+    def _index_msg_ids(self):
+        """Catch the msg_id index up with the log, including other processes' appends
+
+        Caller holds the file lock. The whole log is read once; after that
+        only what was appended since.
+        """
+        stat = os.fstat(self._file.fileno())
+        if self._indexed is None or self._indexed[0] != stat.st_ino or self._indexed[1] > stat.st_size:
+            self._msg_ids = set()
+            self._indexed = (stat.st_ino, 0)
+        if self._indexed[1] < stat.st_size:
+            with open(self.path, "rb") as f:
+                f.seek(self._indexed[1])
+                for line in f:
+                    try:
+                        msg_id = json.loads(line).get("msg_id")
+                    except ValueError:
+                        continue  # Torn line from a crashed writer
+                    if msg_id:
+                        self._msg_ids.add(msg_id)
+            self._indexed = (stat.st_ino, stat.st_size)
+
+    def _reopen_if_replaced(self):
+        """Reopen the log if another process compacted it under us"""
+        if os.fstat(self._file.fileno()).st_ino != os.stat(self.path).st_ino:
+            self.sync()
+            self._file.close()
+            self._file = open(self.path, "a", encoding="utf-8")
+
+    def stamp(self):
+        return file_stamp(self.path)
+
+    def iter_records(self):
+        """Yield every readable record in the log"""
+        return iter_jsonl(self.path)
+
+    def query(self, user1, user2=None, before=None, since=None, limit=None):
+        """Return records exchanged by user1 (with user2 if given), oldest first"""
+        return select_records(self.iter_records(), user1, user2, before, since, limit)
+
+    def iter_query(self, user1, user2=None, before=None, since=None):
+        """Stream matching records in log order, one line at a time"""
+        return iter_matching(self.iter_records(), user1, user2, before, since)
+
+    def sync(self):
+        """Flush pending appends to disk"""
+        with self._lock:
+            if not self._dirty:
+                return
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._dirty = False
+
+    def compact(self):
+        """Rewrite the log sorted by time, dropping torn lines and repeats"""
+        with self._lock, self._file_lock:
+            self.sync()
+            seen = set()
+            records = []
+            for record in self.iter_records():
+                # Copies saved by different processes share the msg_id but not the ciphertext
+                key = record.get("msg_id") or (record.get("sender"), record.get("receiver"),
+                                               record.get("timestamp"), record.get("message"))
+                if key in seen:
+                    continue
+                seen.add(key)
+                records.append(record)
+            records.sort(key=lambda r: r.get("timestamp", 0))
+            self._file.close()
+            self._write_records(records)
+            self._file = open(self.path, "a", encoding="utf-8")
+            self._msg_ids = {record["msg_id"] for record in records if record.get("msg_id")}
+            stat = os.fstat(self._file.fileno())
+            self._indexed = (stat.st_ino, stat.st_size)
+            self._appends_since_compact = 0
+            self._last_compact = time.time()
+
+    def needs_compaction(self):
+        return self._appends_since_compact >= self.compact_threshold and \
+            time.time() - self._last_compact >= self.compact_interval
+
+    def _background(self):
+        while not self._stop.wait(self.fsync_interval):
+            try:
+                self.sync()
+                if self.needs_compaction():
+                    self.compact()
+            except Exception as e:
+                print(f"Error in message log maintenance: {e}")
+
+    def close(self):
+        self._stop.set()
+        with self._lock:
+            self.sync()
+            self._file.close()
+
+
+class ShardedMessageStore:
+    """Message store with one JSON Lines log per conversation pair
+
+    manifest.json maps each conversation key to its shard file. Shard file
+    handles and parsed shard contents are kept in small LRU caches, so a
+    chat only ever reads its own shard. Cached shards are checked against
+    the file's stamp, so appends from other processes are picked up.
+    Shards bigger than `cache_shard_bytes` are never cached, only streamed.
+    """
+
+    def __init__(self, root, legacy_log=None, legacy_path=None, max_open_shards=32,
+                 cache_records=20000, cache_shard_bytes=4 * 1024 * 1024, fsync_interval=0.5):
+        self.root = root
+        self.manifest_path = os.path.join(root, "manifest.json")
+        self.max_open_shards = max_open_shards
+        self.cache_records = cache_records
+        self.cache_shard_bytes = cache_shard_bytes
+        self.fsync_interval = fsync_interval
+        self._lock = threading.RLock()
+        self._open_shards = OrderedDict()  # key -> JsonlMessageStore
+        self._cached = OrderedDict()  # key -> (file stamp, list of records)
+        self._cached_count = 0
+        self._manifest_dirty = False
+        self._manifest_stamp = None
+        self._importing = False
+        self._stop = threading.Event()
+
+        os.makedirs(root, exist_ok=True)
+        self._manifest_lock = file_lock(self.manifest_path + ".lock")
+        with self._manifest_lock:
+            if os.path.exists(self.manifest_path):
+                self.manifest = {"shards": {}}
+                self._refresh_manifest()
+            else:
+                # Split an existing single-file history into shards on first start
+                self.manifest = {"shards": {}}
+                self._import_legacy(legacy_log, legacy_path)
+
+        self._worker = threading.Thread(target=self._background, daemon=True)
+        self._worker.start()
+
+    def _import_legacy(self, legacy_log, legacy_path):
+        """Copy the legacy history into shards, then publish the manifest
+
+        The manifest is only written once every record is in, so a crash
+        part-way leaves no manifest and the next start imports again.
+        """
+        sources = [p for p in (legacy_log, legacy_path) if p and os.path.exists(p)]
+        if not sources:
+            self._save_manifest()
+            return
+        # Without a manifest, any shard files here are left over from an interrupted import
+        for file_name in os.listdir(self.root):
+            if file_name.endswith(".jsonl"):
+                os.remove(os.path.join(self.root, file_name))
+        self._importing = True
+        try:
+            count = copy_records(iter_legacy_records(legacy_log or "", legacy_path or ""), self)
+            self.sync()
+        finally:
+            self._importing = False
+        self._save_manifest()
+        for source in sources:
+            os.replace(source, source + ".migrated")
+        print(f"Migrated {count} messages into {len(self.manifest['shards'])} shards in {self.root}")
+
+    def _refresh_manifest(self):
+        """Merge in shards created by other processes if the manifest changed on disk"""
+        with self._lock:
+            try:
+                stamp = file_stamp(self.manifest_path)
+            except FileNotFoundError:
+                return
+            if stamp == self._manifest_stamp:
+                return
+            with open(self.manifest_path, "r") as f:
+                on_disk = json.load(f)
+            for key, entry in on_disk["shards"].items():
+                mine = self.manifest["shards"].get(key)
+                if mine is None:
+                    self.manifest["shards"][key] = entry
+                else:
+                    mine["count"] = max(mine["count"], entry["count"])
+                    mine["last_timestamp"] = max(mine["last_timestamp"], entry["last_timestamp"])
+            self._manifest_stamp = stamp
+
+    def _save_manifest(self):
+        with self._lock, self._manifest_lock:
+            self._refresh_manifest()
+            write_json_atomic(self.manifest_path, self.manifest)
+            self._manifest_stamp = file_stamp(self.manifest_path)
+            self._manifest_dirty = False
+
+    def _shard_path(self, key):
+        return os.path.join(self.root, self.manifest["shards"][key]["file"])
+
+    def _get_shard(self, key, create=False):
+        """Return the open log for a conversation, opening or creating it"""
+        with self._lock:
+            shard = self._open_shards.get(key)
+            if shard is not None:
+                self._open_shards.move_to_end(key)
+                return shard
+            if key not in self.manifest["shards"]:
+                self._refresh_manifest()
+            if key not in self.manifest["shards"]:
+                if not create:
+                    return None
+                # Hashed names stay unique on case-insensitive file systems, and
+                # two processes creating the same shard agree on its name
+                file_name = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16] + ".jsonl"
+                self.manifest["shards"][key] = {"file": file_name, "count": 0, "last_timestamp": 0}
+                if not self._importing:
+                    self._save_manifest()
+            shard = JsonlMessageStore(self._shard_path(key), background=False)
+            self._open_shards[key] = shard
+            # Evict the least recently used shard handle
+            while len(self._open_shards) > self.max_open_shards:
+                _, evicted = self._open_shards.popitem(last=False)
+                evicted.close()
+            return shard
+
+    def _records(self, key):
+        """Return the records of one shard: the cached list, or a stream for big shards"""
+        with self._lock:
+            shard = self._get_shard(key)
+            if shard is None:
+                return []
+            stamp = shard.stamp()
+            if key in self._cached:
+                cached_stamp, records = self._cached[key]
+                if cached_stamp == stamp:
+                    self._cached.move_to_end(key)
+                    return records
+                # Another process wrote to this shard
+                self._drop_cached(key)
+            if stamp[1] > self.cache_shard_bytes:
+                return shard.iter_records()
+            records = list(shard.iter_records())
+            self._cached[key] = (stamp, records)
+            self._cached_count += len(records)
+            # Evict whole shards until the cache is back under budget
+            while self._cached_count > self.cache_records and len(self._cached) > 1:
+                _, (_, evicted) = self._cached.popitem(last=False)
+                self._cached_count -= len(evicted)
+            return records
+
+    def _drop_cached(self, key):
+        if key in self._cached:
+            self._cached_count -= len(self._cached.pop(key)[1])
+
+    def append(self, record):
+        self.append_many([record])
+
+    def append_many(self, records):
+        by_shard = OrderedDict()
+        for record in records:
+            by_shard.setdefault(conversation_key(record["sender"], record["receiver"]), []).append(record)
+        with self._lock:
+            for key, shard_records in by_shard.items():
+                stamp_before, stamp_after, shard_records = self._get_shard(key, create=True).append_many(shard_records)
+                if not shard_records:
+                    continue  # All already stored
+                entry = self.manifest["shards"][key]
+                entry["count"] += len(shard_records)
+                entry["last_timestamp"] = max(entry["last_timestamp"],
+                                              max(r.get("timestamp", 0) for r in shard_records))
+                self._manifest_dirty = True
+                if key in self._cached:
+                    cached_stamp, cached_records = self._cached[key]
+                    if cached_stamp == stamp_before:
+                        # Nobody else wrote in between; extend the cache in place
+                        cached_records.extend(shard_records)
+                        self._cached[key] = (stamp_after, cached_records)
+                        self._cached_count += len(shard_records)
+                    else:
+                        self._drop_cached(key)
+
+    def shard_keys(self, user):
+        """Conversation keys of every shard that involves user"""
+        return [key for key in self.manifest["shards"] if user in key.split(":")]
+
+    def query(self, user1, user2=None, before=None, since=None, limit=None):
+        matches = deque(self.iter_query(user1, user2, before, since), maxlen=limit)
+        return sorted(matches, key=lambda r: r.get("timestamp", 0))
+
+    def iter_query(self, user1, user2=None, before=None, since=None):
+        """Stream matching records, merging user1's shards in timestamp order"""
+        self._refresh_manifest()
+        if user2:
+            keys = [conversation_key(user1, user2)]
+        else:
+            keys = self.shard_keys(user1)
+        streams = [
+            iter_matching(self._records(key), user1, user2, before, since)
+            for key in keys if key in self.manifest["shards"]
+        ]
+        return heapq.merge(*streams, key=lambda r: r.get("timestamp", 0))
+
+    def iter_records(self):
+        for key in list(self.manifest["shards"]):
+            for record in iter_jsonl(self._shard_path(key)):
+                yield record
+
+    def sync(self):
+        """Make appended records durable; the manifest's counts follow on the next tick"""
+        with self._lock:
+            for shard in self._open_shards.values():
+                shard.sync()
+
+    def _save_manifest_if_dirty(self):
+        with self._lock:
+            if self._manifest_dirty:
+                self._save_manifest()
+
+    def compact(self):
+        with self._lock:
+            for key in list(self.manifest["shards"]):
+                self._get_shard(key).compact()
+                self._drop_cached(key)
+
+    def _background(self):
+        while not self._stop.wait(self.fsync_interval):
+            try:
+                self.sync()
+                self._save_manifest_if_dirty()
+                with self._lock:
+                    for key, shard in list(self._open_shards.items()):
+                        if shard.needs_compaction():
+                            shard.compact()
+                            self._drop_cached(key)
+            except Exception as e:
+                print(f"Error in message shard maintenance: {e}")
+
+    def close(self):
+        self._stop.set()
+        with self._lock:
+            self.sync()
+            self._save_manifest_if_dirty()
+            for shard in self._open_shards.values():
+                shard.close()
+            self._open_shards.clear()
+
+
+class SqliteMessageStore:
+    """Message store backed by SQLite with an index per conversation"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            conversation TEXT NOT NULL,
+            sender TEXT NOT NULL,
+            receiver TEXT NOT NULL,
+            message TEXT NOT NULL,
+            timestamp REAL NOT NULL,
+            msg_id TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (conversation, timestamp);
+        CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages (sender, timestamp);
+        CREATE INDEX IF NOT EXISTS idx_messages_receiver ON messages (receiver, timestamp);
+        CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp);
+    """
+
+    # A message saved by both its sender's and its receiver's client is stored once
+    UNIQUE_MSG_ID = "CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_msg_id ON messages (msg_id)"
+    # Databases from before the unique index may hold copies; keep the first
+    DROP_DUPLICATES = ("DELETE FROM messages WHERE msg_id IS NOT NULL AND id NOT IN "
+                       "(SELECT MIN(id) FROM messages WHERE msg_id IS NOT NULL GROUP BY msg_id)")
+
+    # Statements are kept constant so sqlite3's statement cache reuses them
+    INSERT = ("INSERT OR IGNORE INTO messages (conversation, sender, receiver, message, timestamp, msg_id) "
+              "VALUES (?, ?, ?, ?, ?, ?)")
+    SELECT = "SELECT sender, receiver, message, timestamp, msg_id FROM messages"
+    # Pages are fetched newest first (timestamp window + LIMIT) and reversed
+    RANGE = " AND timestamp >= ? AND timestamp < ?"
+    SELECT_CONVERSATION = (SELECT + " WHERE conversation = ?" + RANGE +
+                           " ORDER BY timestamp DESC LIMIT ?")
+    SELECT_USER = (SELECT + " WHERE sender = ?" + RANGE + " UNION ALL " + SELECT +
+                   " WHERE receiver = ? AND sender != ?" + RANGE +
+                   " ORDER BY timestamp DESC LIMIT ?")
+    SELECT_ALL = SELECT + " ORDER BY timestamp"
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        # SQLite does its own cross-process locking; wait for other writers
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, cached_statements=64)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        if not self._conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'idx_messages_msg_id'").fetchone():
+            self._conn.execute(self.DROP_DUPLICATES)
+            self._conn.execute(self.UNIQUE_MSG_ID)
+        self._conn.commit()
+
+    @staticmethod
+    def _row_to_record(row):
+        record = {
+            "sender": row[0],
+            "receiver": row[1],
+            "message": row[2],
+            "timestamp": row[3]
+        }
+        if row[4] is not None:
+            record["msg_id"] = row[4]
+        return record
+
+    @staticmethod
+    def _record_to_row(record):
+        return (
+            conversation_key(record["sender"], record["receiver"]),
+            record["sender"],
+            record["receiver"],
+            record["message"],
+            record.get("timestamp", 0),
+            record.get("msg_id")
+        )
+
+    def append(self, record):
+        with self._lock:
+            self._conn.execute(self.INSERT, self._record_to_row(record))
+            self._conn.commit()
+
+    def append_many(self, records):
+        with self._lock:
+            self._conn.executemany(self.INSERT, [self._record_to_row(r) for r in records])
+            self._conn.commit()
+
+    def _select(self, sql, params=()):
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [self._row_to_record(row) for row in rows]
+
+    def iter_records(self):
+        return iter(self._select(self.SELECT_ALL))
+
+    def query(self, user1, user2=None, before=None, since=None, limit=None):
+        window = (
+            since if since is not None else float("-inf"),
+            before if before is not None else float("inf")
+        )
+        limit = limit if limit is not None else -1  # -1 means no limit in SQLite
+        if user2:
+            params = (conversation_key(user1, user2),) + window + (limit,)
+            records = self._select(self.SELECT_CONVERSATION, params)
+        else:
+            params = (user1,) + window + (user1, user1) + window + (limit,)
+            records = self._select(self.SELECT_USER, params)
+        records.reverse()
+        return records
+
+    def iter_query(self, user1, user2=None, before=None, since=None):
+        # SQL already filters with the indexes, so the result set is all we hold
+        return iter(self.query(user1, user2, before=before, since=since))
+
+    def sync(self):
+        with self._lock:
+            self._conn.commit()
+
+    def compact(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+
+class _CommitTicket:
+    def __init__(self, records):
+        self.records = records
+        self.done = threading.Event()
+        self.error = None
+
+    def wait(self):
+        """Block until committed; True if the records are durable"""
+        self.done.wait()
+        return self.error is None
+
+
+class GroupCommitWriter:
+    """Coalesces appends from many threads into one durable write per commit
+
+    The writer thread takes the first pending batch, waits up to `window`
+    seconds for more to arrive, then appends and syncs them all at once.
+    """
+
+    def __init__(self, store, window=0.005, max_records=1000):
+        self.store = store
+        self.window = window
+        self.max_records = max_records
+        self.commits = 0
+        self.records_committed = 0
+        self.commit_sizes = deque(maxlen=100)  # Records carried by recent commits
+        self._queue = queue.Queue()
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, records):
+        """Queue records for the next commit and return a ticket to wait on"""
+        ticket = _CommitTicket(list(records))
+        with self._pending_lock:
+            self._pending += 1
+        self._queue.put(ticket)
+        return ticket
+
+    def write(self, records):
+        """Queue records and block until they are durable"""
+        ticket = self.submit(records)
+        ticket.done.wait()
+        if ticket.error:
+            raise ticket.error
+
+    def flush(self):
+        """Block until everything submitted so far has been committed"""
+        if self._pending:
+            self.submit([]).done.wait()
+
+    def stats(self):
+        return {
+            "commits": self.commits,
+            "records": self.records_committed,
+            "last_commit_size": self.commit_sizes[-1] if self.commit_sizes else 0,
+            "max_commit_size": max(self.commit_sizes, default=0)
+        }
+
+    def _run(self):
+        while True:
+            tickets = [self._queue.get()]
+            count = len(tickets[0].records)
+            deadline = time.monotonic() + self.window
+            # Gather whatever else arrives within the commit window
+            while 0 < count < self.max_records:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    ticket = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                tickets.append(ticket)
+                count += len(ticket.records)
+            self._commit(tickets)
+
+    def _commit(self, tickets):
+        records = [record for ticket in tickets for record in ticket.records]
+        error = None
+        if records:
+            try:
+                self.store.append_many(records)
+                self.store.sync()
+                self.commits += 1
+                self.records_committed += len(records)
+                self.commit_sizes.append(len(records))
+                if len(records) > 1:
+                    print(f"Group commit wrote {len(records)} records")
+            except Exception as e:
+                print(f"Error committing messages: {e}")
+                error = e
+        with self._pending_lock:
+            self._pending -= len(tickets)
+        for ticket in tickets:
+            ticket.error = error
+            ticket.done.set()
+
+
+def iter_legacy_records(messages_file="messages.jsonl", legacy_messages_file="messages.json",
+                        messages_dir=None):
+    """Yield messages from the old JSON array file, the JSON Lines log and/or a shard directory"""
+    if os.path.exists(legacy_messages_file):
+        for record in iter_json_array(legacy_messages_file):
+            yield record
+    if os.path.exists(messages_file):
+        for record in iter_jsonl(messages_file):
+            yield record
+    if messages_dir and os.path.exists(os.path.join(messages_dir, "manifest.json")):
+        with open(os.path.join(messages_dir, "manifest.json"), "r") as f:
+            manifest = json.load(f)
+        for entry in manifest["shards"].values():
+            for record in iter_jsonl(os.path.join(messages_dir, entry["file"])):
+                yield record
+
+
+def copy_records(records, store, batch_size=1000):
+    """Append records to a store in batches, skipping malformed ones"""
+    count = 0
+    batch = []
+    for record in records:
+        if not all(k in record for k in ("sender", "receiver", "message")):
+            continue
+        batch.append(record)
+        if len(batch) >= batch_size:
+            store.append_many(batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        store.append_many(batch)
+        count += len(batch)
+    return count
+
+
+def migrate_to_sqlite(db_path="messages.db", messages_file="messages.jsonl",
+                      legacy_messages_file="messages.json", messages_dir="messages"):
+    """One-shot copy of JSON message history into a SQLite store
+
+    A new database is built as `db_path`.tmp and renamed into place when
+    complete, so an interrupted migration never leaves a partial
+    messages.db that later starts would take as finished.
+    """
+    target = db_path
+    if not os.path.exists(db_path):
+        target = db_path + ".tmp"
+        # Left over from an interrupted migration
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            if os.path.exists(target + suffix):
+                os.remove(target + suffix)
+    store = SqliteMessageStore(target)
+    try:
+        count = copy_records(iter_legacy_records(messages_file, legacy_messages_file, messages_dir), store)
+    finally:
+        # Closing the last connection checkpoints the WAL into the database file
+        store.close()
+    if target != db_path:
+        os.replace(target, db_path)
+    print(f"Migrated {count} messages into {db_path}")
+    return count
+
+
+if __name__ == "__main__":
+    # Usage: python storage.py migrate-sqlite [messages.db]
+    if len(sys.argv) >= 2 and sys.argv[1] == "migrate-sqlite":
+        migrate_to_sqlite(sys.argv[2] if len(sys.argv) > 2 else "messages.db")
+    else:
+        print("Usage: python storage.py migrate-sqlite [messages.db]")
@@ -0,0 +1,84 @@
+"""Concurrent write stress test for the message stores
+
+Starts several processes with several writer threads each, all saving to
+one store through Database (blocking and background saves, with
+compactions in between), then checks that every message was stored
+exactly once.
+
+Usage: python stress_storage.py [sharded|jsonl|sqlite ...]
+"""
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from database import Database
+
+PROCESSES = 4
+THREADS = 4
+MESSAGES = 200  # Per thread
+PEERS = ["bob", "carol", "dave"]
+
+
+def writer_process(workdir, backend, process_id):
+    os.chdir(workdir)
+    sys.stdout = open(os.devnull, "w")  # Database logs every save
+    db = Database(backend)
+
+    def writer(thread_id):
+        for i in range(MESSAGES):
+            msg_id = f"p{process_id}_t{thread_id}_{i}"
+            db.save_message(f"user{process_id}", PEERS[i % len(PEERS)], msg_id, msg_id, wait=i % 2 == 0)
+            if i % 50 == 0:
+                db.store.compact()
+        # Every writer also saves the same message; it must be stored once
+        db.save_message("alice", "bob", "shared", "shared_msg_id")
+
+    threads = [threading.Thread(target=writer, args=(t,)) for t in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    db.writer.flush()
+    db.store.close()
+
+
+def run(backend):
+    workdir = tempfile.mkdtemp(prefix=f"stress_{backend}_")
+    try:
+        start = time.time()
+        processes = [
+            multiprocessing.Process(target=writer_process, args=(workdir, backend, p))
+            for p in range(PROCESSES)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        elapsed = time.time() - start
+
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            db = Database(backend)
+            ids = [record.get("msg_id") for record in db.store.iter_records()]
+            db.store.close()
+        finally:
+            os.chdir(cwd)
+
+        expected = PROCESSES * THREADS * MESSAGES + 1
+        ok = all(p.exitcode == 0 for p in processes) and len(ids) == len(set(ids)) == expected
+        print(f"{backend}: {len(ids)} records, {len(set(ids))} unique, expected {expected} "
+              f"({elapsed:.1f}s) {'OK' if ok else 'FAILED'}")
+        return ok
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    backends = sys.argv[1:] or ["sharded", "jsonl", "sqlite"]
+    results = [run(backend) for backend in backends]
+    sys.exit(0 if all(results) else 1)
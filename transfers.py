@@ -0,0 +1,146 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+import weakref
+
+from blobstore import BlobStore, DIGEST_PATTERN, file_digest
+from storage import write_json_atomic
+
+LEGACY_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+EMPTY_SHA256 = hashlib.sha256(b"").hexdigest()
+
+
+class ChecksumMismatch(ValueError):
+    pass
+
+
+class FileStore:
+    """Attachments uploaded to the comm server
+
+    Files are identified by their SHA-256 and kept once in a BlobStore,
+    so announcing a file the server already has completes the upload
+    without sending any bytes. Other uploads arrive in chunks at explicit
+    offsets into `uploads/<digest>.part`; a chunk at the wrong offset is
+    refused with the current size, so a client that lost its connection
+    resumes from what the server has. The last byte moves the file into
+    the blob store once its hash checks out. Two senders of the same file
+    share one upload; their chunks are written one at a time.
+    """
+
+    def __init__(self, root="files", chunk_size=1024 * 1024, max_chunk_size=8 * 1024 * 1024,
+                 upload_ttl=24 * 3600):
+        self.root = root
+        self.uploads_dir = os.path.join(root, "uploads")
+        self.blobs = BlobStore(os.path.join(root, "blobs"))
+        self.chunk_size = chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.upload_ttl = upload_ttl
+        self._locks = weakref.WeakValueDictionary()  # file_id -> asyncio.Lock while chunks are written
+        os.makedirs(self.uploads_dir, exist_ok=True)
+
+    def _upload_path(self, file_id, suffix):
+        if not DIGEST_PATTERN.match(file_id or ""):
+            raise KeyError(file_id)
+        return os.path.join(self.uploads_dir, file_id + suffix)
+
+    def create(self, size, sha256):
+        """Start (or rejoin) the upload of a file with the given hash; returns its status"""
+        if not DIGEST_PATTERN.match(sha256 or ""):
+            raise ValueError("invalid sha256")
+        if not self.blobs.has(sha256) and not os.path.exists(self._upload_path(sha256, ".json")):
+            if size == 0:
+                # No chunk will ever arrive, so an empty file is complete as soon as it is announced
+                if sha256 != EMPTY_SHA256:
+                    raise ChecksumMismatch("content does not match sha256")
+                open(self._upload_path(sha256, ".part"), "wb").close()
+                self.blobs.adopt(self._upload_path(sha256, ".part"), sha256)
+                return self.status(sha256)
+            write_json_atomic(self._upload_path(sha256, ".json"), {"size": size})
+            open(self._upload_path(sha256, ".part"), "wb").close()
+        return self.status(sha256)
+
+    def status(self, file_id):
+        if self.blobs.has(file_id):
+            size = os.path.getsize(self.blobs.path(file_id))
+            return self._status(file_id, size, size, True)
+        try:
+            with open(self._upload_path(file_id, ".json"), "r", encoding="utf-8") as f:
+                size = json.load(f)["size"]
+        except FileNotFoundError:
+            raise KeyError(file_id)
+        return self._status(file_id, size, os.path.getsize(self._upload_path(file_id, ".part")), False)
+
+    def _status(self, file_id, size, received, complete):
+        return {
+            "file_id": file_id,
+            "size": size,
+            "received": received,
+            "complete": complete,
+            "chunk_size": self.chunk_size
+        }
+
+    async def write_chunk(self, file_id, offset, stream):
+        """Append a streamed chunk at `offset`; returns the bytes received so far
+
+        Raises KeyError for unknown uploads and ValueError when the offset
+        doesn't match what the server has, the chunk is too large, or the
+        finished file doesn't match its hash.
+        """
+        lock = self._locks.get(file_id)
+        if lock is None:
+            lock = self._locks[file_id] = asyncio.Lock()
+        # A second sender waits here, then gets the offset mismatch and resumes after our chunk
+        async with lock:
+            status = self.status(file_id)
+            if status["complete"] or offset != status["received"]:
+                raise ValueError("offset mismatch")
+            limit = min(self.max_chunk_size, status["size"] - offset)
+            part_path = self._upload_path(file_id, ".part")
+            written = 0
+            with open(part_path, "ab") as f:
+                async for data in stream:
+                    written += len(data)
+                    if written > limit:
+                        # Drop the partial chunk so the client can retry from `offset`
+                        f.truncate(offset)
+                        raise ValueError("chunk too large")
+                    f.write(data)
+            received = offset + written
+            if received == status["size"]:
+                # Hash off the event loop; large files take a while
+                if await asyncio.to_thread(file_digest, part_path) != file_id:
+                    # Corrupt upload; start it over
+                    open(part_path, "wb").close()
+                    raise ChecksumMismatch("content does not match sha256")
+                self.blobs.adopt(part_path, file_id)
+                os.remove(self._upload_path(file_id, ".json"))
+            return received
+
+    def path(self, file_id):
+        """Path of a completed file (or of a pre-content-addressing upload)"""
+        if LEGACY_ID_PATTERN.match(file_id or ""):
+            path = os.path.join(self.root, file_id)
+            if os.path.exists(path):
+                return path
+            raise KeyError(file_id)
+        path = self.blobs.path(file_id)
+        if not os.path.exists(path):
+            raise KeyError(file_id)
+        return path
+
+    def gc(self):
+        """Drop abandoned uploads and unreferenced blobs; returns how many files went"""
+        cutoff = time.time() - self.upload_ttl
+        removed = 0
+        for file_name in os.listdir(self.uploads_dir):
+            path = os.path.join(self.uploads_dir, file_name)
+            if file_name.endswith(".part") and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                meta_path = path[:-len(".part")] + ".json"
+                if os.path.exists(meta_path):
+                    os.remove(meta_path)
+                removed += 1
+        return removed + self.blobs.gc()
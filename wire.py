@@ -0,0 +1,157 @@
+import base64
+import json
+import os
+import zlib
+
+try:
+    import msgpack
+except ImportError:  # Optional; without it every connection stays on JSON
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # Optional; body compression falls back to zlib
+    zstandard = None
+
+JSON = "json"
+MSGPACK = "msgpack"
+
+ZSTD = "zstd"
+ZLIB = "zlib"
+
+# Start of the json.dumps'd attachment payloads built in main.py: a {"name", "file_id",
+# "size"} reference to an uploaded blob, or a legacy inline {"name", "data"} (base64).
+# comm_server.attachment_id matches on it too.
+FILE_PREFIX = '{"name": '
+# Only legacy inline payloads carry the file itself; references go out as plain content
+INLINE_DATA = '"data": '
+
+# Bodies at least this big are compressed in MessagePack frames
+COMPRESS_THRESHOLD = int(os.getenv("COMM_COMPRESS_THRESHOLD", "4096"))
+COMPRESS_LEVEL = int(os.getenv("COMM_COMPRESS_LEVEL", "3"))
+MAX_DECOMPRESSED = 64 * 1024 * 1024  # Refuse frames that claim to inflate beyond this
+
+_zstd_compressors = {}
+
+
+def available_formats():
+    return [JSON, MSGPACK] if msgpack is not None else [JSON]
+
+
+def choose_format(requested):
+    """The format to use for a connection that asked for `requested`"""
+    return requested if requested in available_formats() else JSON
+
+
+def available_codecs():
+    return [ZSTD, ZLIB] if zstandard is not None else [ZLIB]
+
+
+def choose_codec(offered):
+    """First codec from the peer's preference list that we support, or None"""
+    for codec in offered:
+        if codec in available_codecs():
+            return codec
+    return None
+
+
+def compress(data, codec, level=None):
+    level = COMPRESS_LEVEL if level is None else level
+    if codec == ZSTD:
+        if level not in _zstd_compressors:
+            _zstd_compressors[level] = zstandard.ZstdCompressor(level=level)
+        return _zstd_compressors[level].compress(data)
+    return zlib.compress(data, max(0, min(level, 9)))
+
+
+def decompress(data, codec):
+    if codec == ZSTD:
+        if zstandard is None:
+            raise ValueError("zstd frame received but zstandard is not installed")
+        size = zstandard.frame_content_size(data)
+        if size < 0 or size > MAX_DECOMPRESSED:
+            raise ValueError("zstd frame has no or too large a content size")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == ZLIB:
+        inflater = zlib.decompressobj()
+        result = inflater.decompress(data, MAX_DECOMPRESSED)
+        if inflater.unconsumed_tail:
+            raise ValueError("zlib frame inflates beyond the size limit")
+        return result
+    raise ValueError(f"unknown codec {codec!r}")
+
+
+def _maybe_compress(data, codec):
+    """Compressed bytes if they save at least 10%, else None (e.g. already-compressed files)"""
+    if codec is None or len(data) < COMPRESS_THRESHOLD:
+        return None
+    packed = compress(data, codec)
+    return packed if len(packed) < len(data) * 0.9 else None
+
+
+def encode(frame, fmt=JSON, codec=None):
+    """Serialize a protocol frame: a str for JSON text frames, bytes for MessagePack
+
+    In MessagePack, legacy inline attachment content (a JSON string carrying
+    base64 data) is sent as a map with the raw file bytes instead; blob
+    references are small and stay ordinary content. With a `codec`
+    large text or file bodies are compressed. JSON frames rely on the
+    websocket's permessage-deflate instead.
+    """
+    if fmt != MSGPACK:
+        return json.dumps(frame)
+    content = frame.get("content")
+    if not isinstance(content, str):
+        return msgpack.packb(frame, use_bin_type=True)
+    frame = {key: value for key, value in frame.items() if key != "content"}
+    attachment = None
+    if content.startswith(FILE_PREFIX) and INLINE_DATA in content:
+        try:
+            payload = json.loads(content)
+            attachment = {"name": payload["name"], "data": base64.b64decode(payload["data"])}
+        except (ValueError, KeyError, TypeError):
+            attachment = None
+    if attachment is not None:
+        packed = _maybe_compress(attachment["data"], codec)
+        if packed is not None:
+            attachment = {"name": attachment["name"], "data_z": packed}
+            frame["codec"] = codec
+        frame["file"] = attachment
+    else:
+        packed = _maybe_compress(content.encode("utf-8"), codec)
+        if packed is not None:
+            frame["content_z"] = packed
+            frame["codec"] = codec
+        else:
+            frame["content"] = content
+    return msgpack.packb(frame, use_bin_type=True)
+
+
+def decode(data):
+    """Parse a text (JSON) or binary (MessagePack) frame back into the JSON frame shape
+
+    Raises ValueError for malformed frames.
+    """
+    if isinstance(data, str):
+        return json.loads(data)
+    if msgpack is None:
+        raise ValueError("binary frame received but msgpack is not installed")
+    try:
+        frame = msgpack.unpackb(data, raw=False)
+    except Exception as e:
+        raise ValueError(f"invalid msgpack frame: {e}")
+    if not isinstance(frame, dict):
+        raise ValueError("frame is not a map")
+    codec = frame.pop("codec", None)
+    if "content_z" in frame:
+        frame["content"] = decompress(frame.pop("content_z"), codec).decode("utf-8")
+    attachment = frame.pop("file", None)
+    if attachment is not None:
+        if "data_z" in attachment:
+            raw = decompress(attachment["data_z"], codec)
+        else:
+            raw = attachment["data"]
+        # Same text json.dumps would produce; base64 never needs escaping, so skip the scan
+        data = base64.b64encode(raw).decode("ascii")
+        frame["content"] = FILE_PREFIX + json.dumps(attachment["name"]) + ', "data": "' + data + '"}'
+    return frame